@@ -91,6 +91,15 @@ def main():
                        dest='verify_library',
                        action='store_true',
                        help='Check metadata for all tracks in ROOT_PATH or listed in SONG_ARCHIVE, updating the metadata if necessary. This will not download any new tracks, but may take a very, very long time.')
+    group.add_argument('--sync',
+                       type=str,
+                       nargs='*',
+                       dest='sync',
+                       help='Sync the playlist URL(s) given, or every playlist saved by your account, skipping unchanged playlists and downloading only songs added since the last sync. Repeats every SYNC_INTERVAL minutes if set.')
+    group.add_argument('--serve',
+                       dest='serve',
+                       action='store_true',
+                       help='Stay logged in and run download jobs submitted to a local HTTP API (see SERVE_PORT), until interrupted')
     
     for flag in DEPRECIATED_FLAGS: 
         group.add_argument(*flag["flags"],
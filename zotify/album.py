@@ -1,29 +1,60 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+
 from zotify.config import Zotify
-from zotify.const import ALBUM_URL, ARTIST_URL, ITEMS, ARTISTS, NAME, ID, DISC_NUMBER, ALBUM_TYPE, COMPILATION, AVAIL_MARKETS
+from zotify.const import ARTIST_URL, ITEMS, ARTISTS, NAME, ID, DISC_NUMBER, ALBUM_TYPE, COMPILATION, AVAIL_MARKETS, \
+    ALBUM_BULK_URL, ALBUMS, TRACKS, ALBUM, TOTAL_TRACKS, TRACK_BULK_URL, LINKED_FROM
 from zotify.termoutput import Printer, PrintChannel, Loader
 from zotify.track import download_track
 from zotify.utils import fix_filename
 
 
-def get_album_info(album_id: str) -> tuple[str, str, list[dict], int, bool]:
-    """ Returns album info and tracklist"""
-    
-    (raw, resp) = Zotify.invoke_url(f'{ALBUM_URL}/{album_id}')
+EXPANSION_WORKERS = 4
+ALBUM_BULK_LIMIT = 20
+
+# DOWNLOAD_PARENT_ALBUM bookkeeping, lives for the whole run
+PARENT_ALBUMS: dict[str, tuple[str, int]] = {}
+COMPLETED_ALBUMS: dict[str, tuple] = {}
+
+
+def parse_album_info(resp: dict) -> tuple[str, str, list[dict], int, bool]:
+    """ Returns album info and tracklist from a full album object """
     
     album_name = fix_filename(resp[NAME])
     album_artists = [artist[NAME] for artist in resp[ARTISTS]]
     compilation = resp[ALBUM_TYPE] == COMPILATION
     
-    tracks = Zotify.invoke_url_nextable(f'{ALBUM_URL}/{album_id}/tracks', ITEMS)
+    # the first page of tracks is embedded, only albums with more than 50 tracks need further requests
+    tracks = Zotify.invoke_url_next_pages(resp[TRACKS], ITEMS, params={'market': 'from_token'})
     
     total_discs = tracks[-1][DISC_NUMBER]
     
     return album_name, album_artists, tracks, total_discs, compilation
 
 
-def get_artist_album_ids(artist_id):
+def get_albums_info(album_ids: list[str]) -> list[tuple[str, str, list[dict], int, bool] | None]:
+    """ Returns album info and tracklists, resolving up to 20 albums per request """
+    
+    albums = Zotify.invoke_url_bulk(ALBUM_BULK_URL, album_ids, ALBUMS, limit=ALBUM_BULK_LIMIT)
+    
+    # unavailable albums are returned as null
+    return [parse_album_info(album) if album else None for album in albums]
+
+
+def get_album_info(album_id: str) -> tuple[str, str, list[dict], int, bool]:
+    """ Returns album info and tracklist"""
+    
+    album_info = get_albums_info([album_id])[0]
+    if album_info is None:
+        raise ValueError(f'Album not found: {album_id}')
+    
+    return album_info
+
+
+def get_artist_album_ids(artist_id, show_loader: bool = True):
     """ Returns artist's albums """
-    with Loader(PrintChannel.PROGRESS_INFO, "Fetching artist information..."):
+    with Loader(PrintChannel.PROGRESS_INFO, "Fetching artist information...") if show_loader else nullcontext():
         # excludes "appears_on" and "compilations"
         url = f'{ARTIST_URL}/{artist_id}/albums?include_groups=album%2Csingle'
         simple_albums = Zotify.invoke_url_nextable(url, ITEMS)
@@ -31,44 +62,120 @@ def get_artist_album_ids(artist_id):
     return [album[ID] for album in simple_albums]
 
 
-def download_artist_albums(artist, pbar_stack: list | None = None):
+def expand_artists(artist_ids: list[str]) -> list[list[tuple[str, tuple]]]:
+    """ Resolves every artist's album list and each album's tracklist concurrently, preserving order """
+    with ThreadPoolExecutor(max_workers=EXPANSION_WORKERS, thread_name_prefix="zotify-expand") as executor:
+        artist_album_ids = list(executor.map(partial(get_artist_album_ids, show_loader=False), artist_ids))
+        
+        # albums shared between artists (collaborations) only need resolving once
+        unique_album_ids = list(dict.fromkeys(album_id for album_ids in artist_album_ids for album_id in album_ids))
+        batches = [unique_album_ids[i:i + ALBUM_BULK_LIMIT] for i in range(0, len(unique_album_ids), ALBUM_BULK_LIMIT)]
+        album_infos = {}
+        for batch, batch_infos in zip(batches, executor.map(get_albums_info, batches)):
+            album_infos.update(zip(batch, batch_infos))
+    
+    return [[(album_id, album_infos[album_id]) for album_id in album_ids if album_infos.get(album_id)]
+            for album_ids in artist_album_ids]
+
+
+def download_artist_albums(artist, pbar_stack: list | None = None, albums: list[tuple[str, tuple]] | None = None):
     """ Downloads albums of an artist """
-    album_ids = get_artist_album_ids(artist)
+    if albums is None:
+        with Loader(PrintChannel.PROGRESS_INFO, "Fetching artist information..."):
+            albums = expand_artists([artist])[0]
     
     pos, pbar_stack = Printer.pbar_position_handler(5, pbar_stack)
-    pbar = Printer.pbar(album_ids, unit='album', pos=pos,
+    pbar = Printer.pbar(albums, unit='album', pos=pos,
                         disable=not Zotify.CONFIG.get_show_artist_pbar())
     pbar_stack.append(pbar)
     
-    for album_id in pbar:
-        download_album(album_id, pbar_stack)
-        pbar.set_description(get_album_info(album_id)[0])
+    for album_id, album_info in pbar:
+        download_album(album_id, pbar_stack, album_info=album_info)
+        pbar.set_description(album_info[0])
         Printer.refresh_all_pbars(pbar_stack)
 
 
-def download_album(album_id: str, pbar_stack: list | None = None, M3U8_bypass: str | None = None) -> bool:
-    """ Downloads songs from an album """
-    album_name, album_artists, tracks, total_discs, compilation = get_album_info(album_id)
+def get_track_ids(track: dict) -> set[str]:
+    """ Returns a track's id along with the id it was requested by, if it was relinked for the user's market """
+    track_ids = {track[ID]}
+    if track.get(LINKED_FROM) and track[LINKED_FROM].get(ID):
+        track_ids.add(track[LINKED_FROM][ID])
+    return track_ids
+
+
+def register_parent_albums(tracks: list[dict | None]) -> None:
+    """ Remembers the parent album of already fetched track objects, avoiding a TRACK_URL lookup per track """
+    for track in tracks:
+        if track and track.get(ID) and track.get(ALBUM) and track[ALBUM].get(ID):
+            for track_id in get_track_ids(track):
+                PARENT_ALBUMS[track_id] = (track[ALBUM][ID], track[ALBUM][TOTAL_TRACKS])
+
+
+def get_parent_album(track_id: str) -> tuple[str | None, int | None]:
+    """ Returns a track's album id and total tracks """
+    if track_id not in PARENT_ALBUMS:
+        try:
+            (raw, info) = Zotify.invoke_url(TRACK_BULK_URL + track_id)
+            register_parent_albums(info[TRACKS][:1])
+        except:
+            Printer.hashtaged(PrintChannel.ERROR, 'FAILED TO FIND PARENT ALBUM\n' +\
+                                                 f'Track_ID: {track_id}')
+    return PARENT_ALBUMS.get(track_id, (None, None))
+
+
+def download_parent_album(mode: str, track_id: str, pbar_stack: list | None = None, requester_keys: dict | None = None) -> bool | None:
+    """ Downloads a track's parent album once per run, returns None if the track should be downloaded on its own,
+    else whether every track of the album finished. The requested track's path is reported in `requester_keys` """
+    album_id, total_tracks = get_parent_album(track_id)
+    if not album_id or not total_tracks or int(total_tracks) <= 1:
+        return None
+    
+    # uses album OUTPUT template for track_path formatting, but handle m3u8 as if only this track was downloaded
+    if album_id in COMPLETED_ALBUMS:
+        if Zotify.CONFIG.get_export_m3u8():
+            # already downloaded this run, revisit only this track so it still gets its m3u8 entry
+            return download_album(album_id, pbar_stack, M3U8_bypass=(mode, track_id),
+                                  album_info=COMPLETED_ALBUMS[album_id], only_track_id=track_id, requester_keys=requester_keys)
+        else:
+            Printer.hashtaged(PrintChannel.SKIPPING, 'PARENT ALBUM ALREADY DOWNLOADED THIS SESSION\n' +\
+                                                    f'Album_Name: {COMPLETED_ALBUMS[album_id][0]} - Track_ID: {track_id}')
+        return True
+    
+    return download_album(album_id, pbar_stack, M3U8_bypass=(mode, track_id), requester_keys=requester_keys)
+
+
+def download_album(album_id: str, pbar_stack: list | None = None, M3U8_bypass: tuple[str, str] | None = None,
+                   album_info: tuple | None = None, only_track_id: str | None = None, requester_keys: dict | None = None) -> bool:
+    """ Downloads songs from an album, returns False if any of them failed, filtered albums count as finished """
+    if album_info is None:
+        album_info = get_album_info(album_id)
+    album_name, album_artists, tracks, total_discs, compilation = album_info
     char_num = max({len(str(len(tracks))), 2})
     
     if Zotify.CONFIG.get_skip_comp_albums() and compilation:
         Printer.hashtaged(PrintChannel.SKIPPING, 'ALBUM IS A COMPILATION\n' +\
                                              f'Album_Name: {album_name} - Album_ID: {album_id}')
-        return False
+        return True
     elif Zotify.CONFIG.get_regex_album():
         regex_match = Zotify.CONFIG.get_regex_album().search(album_name)
         if regex_match:
             Printer.hashtaged(PrintChannel.SKIPPING, 'ALBUM MATCHES REGEX FILTER\n' +\
                                                     f'Album_Name: {album_name} - Album_ID: {album_id}\n'+\
                                                    (f'Regex Groups: {regex_match.groupdict()}\n' if regex_match.groups() else ""))
-            return False
+            return True
+    
+    album_nums = {track[ID]: n for n, track in enumerate(tracks, 1)}
+    if only_track_id is not None:
+        tracks = [track for track in tracks if only_track_id in get_track_ids(track)]
     
     pos, pbar_stack = Printer.pbar_position_handler(3, pbar_stack)
     pbar = Printer.pbar(tracks, unit='song', pos=pos, 
                         disable=not Zotify.CONFIG.get_show_album_pbar())
     pbar_stack.append(pbar)
     
-    for n, track in enumerate(pbar, 1):
+    finished = True
+    for track in pbar:
+        n = album_nums[track[ID]]
         
         extra_keys={'album_num': str(n).zfill(char_num), 
                     'album_artists': album_artists, 
@@ -77,11 +184,20 @@ def download_album(album_id: str, pbar_stack: list | None = None, M3U8_bypass: s
                     'total_discs': total_discs}
         
         if M3U8_bypass is not None:
-            extra_keys['M3U8_bypass'] = M3U8_bypass
+            bypass_mode, bypass_id = M3U8_bypass
+            # a relinked track is listed under a different id than the one originally requested
+            if bypass_id in get_track_ids(track):
+                bypass_id = track[ID]
+                extra_keys['requester_keys'] = requester_keys
+            extra_keys['M3U8_bypass'] = (bypass_mode, bypass_id)
         
-        download_track('album', track[ID], 
-                       extra_keys,
-                       pbar_stack)
+        finished = download_track('album', track[ID], 
+                                  extra_keys,
+                                  pbar_stack) and finished
         pbar.set_description(track[NAME])
         Printer.refresh_all_pbars(pbar_stack)
-    return True
+    
+    # a later request for one of its tracks retries the album, its downloaded tracks are skipped as archived
+    if finished:
+        COMPLETED_ALBUMS[album_id] = album_info
+    return finished
@@ -2,15 +2,21 @@ from argparse import Namespace
 from librespot.audio.decoders import AudioQuality
 from pathlib import Path, PurePath
 
-from zotify.album import download_album, download_artist_albums
+from zotify.album import download_album, download_artist_albums, expand_artists, register_parent_albums
 from zotify.config import Zotify
 from zotify.const import TRACK, NAME, ID, ARTIST, ARTISTS, ITEMS, TRACKS, EXPLICIT, ALBUM, ALBUMS, OWNER, \
     PLAYLIST, PLAYLISTS, DISPLAY_NAME, USER_FOLLOWED_ARTISTS_URL, USER_SAVED_TRACKS_URL, SEARCH_URL, TRACK_BULK_URL
-from zotify.playlist import get_playlist_info, download_from_user_playlist, download_playlist
+from zotify.playlist import get_playlist_info, download_from_user_playlist, download_playlist, sync_playlists, \
+    watch_playlists
 from zotify.podcast import download_episode, download_show
-from zotify.termoutput import Printer, PrintChannel
+from zotify.metrics import Metrics
+from zotify.perf import Perf
+from zotify.serve import serve
+from zotify.termoutput import Printer, PrintChannel, Loader
 from zotify.track import download_track, update_track_metadata
-from zotify.utils import split_sanitize_intrange, regex_input_for_urls, walk_directory_for_tracks, get_archived_entries
+from zotify.transcode import TranscodePool
+from zotify.utils import split_sanitize_intrange, regex_input_for_urls, walk_directory_for_tracks, get_archived_entries, \
+    strptime_utc, get_liked_songs_watermark, set_liked_songs_watermark
 
 
 def download_from_urls(urls: list[str]) -> int:
@@ -51,6 +57,84 @@ def download_from_urls(urls: list[str]) -> int:
     return download
 
 
+def download_liked_songs() -> None:
+    """ Downloads every song in the account's Liked Songs, or only those added since the last run if incremental """
+    stop = None
+    watermark = get_liked_songs_watermark() if Zotify.CONFIG.get_incremental_liked_songs() else None
+    if watermark is not None:
+        # saved tracks come newest first, so paging can end at the first song older than the last run's newest.
+        # songs added at the watermark itself are fetched again, which keeps the Liked Songs m3u8 merge working
+        stop = lambda song: strptime_utc(song['added_at']) < watermark
+    liked_songs = Zotify.invoke_url_nextable(USER_SAVED_TRACKS_URL, ITEMS, stop=stop)
+    if Zotify.CONFIG.get_download_parent_album():
+        register_parent_albums([song[TRACK] for song in liked_songs])
+    pos = 3
+    pbar = Printer.pbar(liked_songs, unit='song', pos=pos, 
+                        disable=not Zotify.CONFIG.get_show_playlist_pbar())
+    pbar_stack = [pbar]
+    
+    failed = []
+    for song in pbar:
+        if not song[TRACK][NAME] or not song[TRACK][ID]:
+            Printer.hashtaged(PrintChannel.SKIPPING, 'SONG NO LONGER EXISTS\n' +\
+                                                    f'Track_Name: {song[TRACK][NAME]} - Track_ID: {song[TRACK][ID]}')
+        else:
+            if not download_track('liked', song[TRACK][ID], None, pbar_stack):
+                failed.append(song)
+            pbar.set_description(song[TRACK][NAME])
+            Printer.refresh_all_pbars(pbar_stack)
+    
+    if Zotify.CONFIG.get_incremental_liked_songs() and liked_songs:
+        # conversions that fail in the background count as failed too
+        TranscodePool.join()
+        failed += [song for song in liked_songs if song[TRACK][ID] and TranscodePool.failed(song[TRACK][ID])]
+        if failed:
+            # held at the oldest song that did not finish, songs at or after it are fetched again next run
+            set_liked_songs_watermark(min((song['added_at'] for song in failed), key=strptime_utc))
+        else:
+            set_liked_songs_watermark(max((song['added_at'] for song in liked_songs), key=strptime_utc))
+
+
+def download_followed_artists() -> None:
+    """ Downloads every album of every artist the account follows """
+    followed_artists = Zotify.invoke_url_nextable(USER_FOLLOWED_ARTISTS_URL, ITEMS, stripper=ARTISTS)
+    with Loader(PrintChannel.PROGRESS_INFO, "Fetching followed artists' albums..."):
+        artists_albums = expand_artists([artist[ID] for artist in followed_artists])
+    
+    pos = 7
+    pbar = Printer.pbar(followed_artists, unit='artist', pos=pos, 
+                        disable=not Zotify.CONFIG.get_show_url_pbar())
+    pbar_stack = [pbar]
+    
+    for artist, albums in zip(pbar, artists_albums):
+        download_artist_albums(artist[ID], pbar_stack, albums)
+        pbar.set_description(artist[NAME])
+        Printer.refresh_all_pbars(pbar_stack)
+
+
+def verify_library() -> None:
+    """ Updates the metadata of archived tracks found in ROOT_PATH to match the API """
+    # ONLY WORKS WITH ARCHIVED TRACKS (THEORETICALLY GUARANTEES BULK_URL TO WORK)
+    archived_tracks = get_archived_entries()
+    archived_ids = [entry.strip().split('\t')[0] for entry in archived_tracks]
+    archived_filenames = [PurePath(entry.strip().split('\t')[4]).stem for entry in archived_tracks]
+    
+    track_paths: list[Path] = []; track_ids: list[str] = []
+    library = walk_directory_for_tracks(Zotify.CONFIG.get_root_path())
+    for entry in library:
+        if entry.stem in archived_filenames:
+            track_paths.append(entry)
+            track_ids.append(archived_ids[archived_filenames.index(entry.stem)])
+    
+    tracks = Zotify.invoke_url_bulk(TRACK_BULK_URL, track_ids, TRACKS)
+    
+    pos = 1
+    pbar = Printer.pbar(track_paths, unit='tracks', pos=pos, 
+                        disable=not Zotify.CONFIG.get_show_url_pbar())
+    for i, track_path in enumerate(pbar):
+        update_track_metadata(track_ids[i], track_path, tracks[i])
+
+
 def search(search_term) -> None:
     """ Searches download server's API for relevant data """
     params = {'limit': '10',
@@ -226,6 +310,7 @@ def search(search_term) -> None:
 def client(args: Namespace) -> None:
     """ Connects to download server to perform query's and get songs to download """
     Zotify(args)
+    Metrics.start()
     
     Printer.splash()
     
@@ -260,33 +345,10 @@ def client(args: Namespace) -> None:
         download_from_user_playlist()
     
     elif args.liked_songs:
-        
-        liked_songs = Zotify.invoke_url_nextable(USER_SAVED_TRACKS_URL, ITEMS)
-        pos = 3
-        pbar = Printer.pbar(liked_songs, unit='song', pos=pos, 
-                            disable=not Zotify.CONFIG.get_show_playlist_pbar())
-        pbar_stack = [pbar]
-        
-        for song in pbar:
-            if not song[TRACK][NAME] or not song[TRACK][ID]:
-                Printer.hashtaged(PrintChannel.SKIPPING, 'SONG NO LONGER EXISTS\n' +\
-                                                        f'Track_Name: {song[TRACK][NAME]} - Track_ID: {song[TRACK][ID]}')
-            else:
-                download_track('liked', song[TRACK][ID], None, pbar_stack)
-                pbar.set_description(song[TRACK][NAME])
-                Printer.refresh_all_pbars(pbar_stack)
+        download_liked_songs()
     
     elif args.followed_artists:
-        followed_artists = Zotify.invoke_url_nextable(USER_FOLLOWED_ARTISTS_URL, ITEMS, stripper=ARTISTS)
-        pos = 7
-        pbar = Printer.pbar(followed_artists, unit='artist', pos=pos, 
-                            disable=not Zotify.CONFIG.get_show_url_pbar())
-        pbar_stack = [pbar]
-        
-        for artist in pbar:
-            download_artist_albums(artist[ID], pbar_stack)
-            pbar.set_description(artist[NAME])
-            Printer.refresh_all_pbars(pbar_stack)
+        download_followed_artists()
     
     elif args.search:
         if args.search == ' ':
@@ -300,27 +362,35 @@ def client(args: Namespace) -> None:
                 search(args.search)
     
     elif args.verify_library:
-        # ONLY WORKS WITH ARCHIVED TRACKS (THEORETICALLY GUARANTEES BULK_URL TO WORK)
-        archived_tracks = get_archived_entries()
-        archived_ids = [entry.strip().split('\t')[0] for entry in archived_tracks]
-        archived_filenames = [PurePath(entry.strip().split('\t')[4]).stem for entry in archived_tracks]
-        
-        track_paths: list[Path] = []; track_ids: list[str] = []
-        library = walk_directory_for_tracks(Zotify.CONFIG.get_root_path())
-        for entry in library:
-            if entry.stem in archived_filenames:
-                track_paths.append(entry)
-                track_ids.append(archived_ids[archived_filenames.index(entry.stem)])
-        
-        tracks = Zotify.invoke_url_bulk(TRACK_BULK_URL, track_ids, TRACKS)
-        
-        pos = 1
-        pbar = Printer.pbar(track_paths, unit='tracks', pos=pos, 
-                            disable=not Zotify.CONFIG.get_show_url_pbar())
-        for i, track_path in enumerate(pbar):
-            update_track_metadata(track_ids[i], track_path, tracks[i])
+        verify_library()
+    
+    elif args.sync is not None:
+        watch_playlists(args.sync)
+    
+    elif args.serve:
+        try:
+            serve({'urls': lambda job: download_from_urls(job['urls']),
+                   'liked': lambda job: download_liked_songs(),
+                   'followed': lambda job: download_followed_artists(),
+                   'verify': lambda job: verify_library(),
+                   'sync': lambda job: sync_playlists(job['urls'])})
+        except KeyboardInterrupt:
+            Printer.hashtaged(PrintChannel.MANDATORY, 'SHUTTING DOWN, UNFINISHED JOBS RESUME ON NEXT START')
     
     else:
         search(Printer.get_input('Enter search: '))
     
+    TranscodePool.join()
+    
+    if Zotify.FFMPEG_SKIPS:
+        Printer.hashtaged(PrintChannel.DOWNLOADS, f'SKIPPED FFMPEG FOR {Zotify.FFMPEG_SKIPS} ALREADY PLAYABLE TRACKS\n' +\
+                                                  f'({Zotify.FFMPEG_SKIPPED_BYTES / 2**20:.1f} MiB NOT REWRITTEN)')
+    
     Printer.debug(f"Total API Calls: {Zotify.TOTAL_API_CALLS}")
+    
+    if Zotify.CONFIG.get_print_perf_report():
+        Perf.print_report()
+    if Zotify.CONFIG.get_perf_report_file():
+        Perf.export(Zotify.CONFIG.get_perf_report_file())
+    Metrics.stop()
+    Zotify.AUTH_STOP.set()
@@ -0,0 +1,533 @@
+#! /usr/bin/env python3
+
+"""
+Zotify Bench
+Runs scripted download scenarios against a local stand-in for the Web API and a fake content feeder,
+reporting throughput, API calls per track and peak memory, so regressions show up without an account.
+"""
+
+import argparse
+import json
+import random
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from pathlib import Path
+from threading import Lock, Thread
+from types import SimpleNamespace
+from urllib.parse import urlencode, urlsplit, parse_qs
+
+import requests
+from librespot.audio.decoders import AudioQuality
+from PIL import Image
+
+from zotify.config import Zotify, CONFIG_VALUES
+from zotify.const import SNAPSHOT_ID, BASE_URL, LYRICS_URL, ID, NAME, ITEMS, TRACKS, ALBUMS, ARTISTS, IMAGES, URL, WIDTH, \
+    RELEASE_DATE, TOTAL_TRACKS, TRACK_NUMBER, DISC_NUMBER, ALBUM, ALBUM_TYPE, DURATION_MS, IS_PLAYABLE, GENRES, \
+    TRACK, TYPE, OWNER, DISPLAY_NAME, ERROR
+from zotify.perf import Perf
+from zotify.termoutput import Printer, PrintChannel
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+
+KIND_PREFIX = {TRACK: '1', ALBUM: '2', 'artist': '3', 'playlist': '4'}
+
+
+def make_id(kind: str, n: int) -> str:
+    """ Returns a valid base62 id that encodes its kind and index """
+    return f'{KIND_PREFIX[kind]}{n:021d}'
+
+
+def parse_id(content_id: str) -> int:
+    return int(content_id[1:])
+
+
+# Synthetic Audio
+OGG_CRC_TABLE = []
+for i in range(256):
+    r = i << 24
+    for _ in range(8):
+        r = ((r << 1) ^ 0x04C11DB7) if r & 0x80000000 else (r << 1)
+    OGG_CRC_TABLE.append(r & 0xFFFFFFFF)
+
+
+def ogg_crc(data: bytes) -> int:
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ OGG_CRC_TABLE[((crc >> 24) & 0xFF) ^ byte]
+    return crc
+
+
+def ogg_page(packets: list[bytes], granule: int, sequence: int, flags: int = 0, serial: int = 0x5A07) -> bytes:
+    lacing = bytearray()
+    for packet in packets:
+        lacing.extend([255] * (len(packet) // 255))
+        lacing.append(len(packet) % 255)
+    header = struct.pack('<4sBBqIIIB', b'OggS', 0, flags, granule, serial, sequence, 0, len(lacing)) + bytes(lacing)
+    page = bytearray(header + b''.join(packets))
+    page[22:26] = struct.pack('<I', ogg_crc(page))
+    return bytes(page)
+
+
+def synthetic_ogg(size: int, duration_s: int, sample_rate: int = 44100) -> bytes:
+    """ Returns an Ogg Vorbis file of roughly `size` bytes with valid headers and page checksums but noise for audio """
+    identification = b'\x01vorbis' + struct.pack('<IBIiiiBB', 0, 2, sample_rate, 0, 160000, 0, 0xB8, 1)
+    comment = b'\x03vorbis' + struct.pack('<I', 11) + b'zotifybench' + struct.pack('<I', 0) + b'\x01'
+    setup = b'\x05vorbis' + bytes(64)
+    
+    pages = [ogg_page([identification], 0, 0, flags=0x02),
+             ogg_page([comment, setup], 0, 1)]
+    
+    rng = random.Random(0)
+    packet_size = 4000
+    n_pages = max(size // packet_size, 1)
+    for n in range(1, n_pages + 1):
+        granule = duration_s * sample_rate * n // n_pages
+        pages.append(ogg_page([rng.randbytes(packet_size)], granule, n + 1, flags=0x04 if n == n_pages else 0))
+    return b''.join(pages)
+
+
+def synthetic_jpeg(size: int = 640) -> bytes:
+    buffer = BytesIO()
+    Image.new('RGB', (size, size), (30, 215, 96)).save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+# generated once per run, every track and cover shares them
+AUDIO = b''
+IMAGE = b''
+CATALOGUE = None
+
+
+# Fake Session
+class FakeAudioStream:
+    """ Serves a synthetic file no faster than `bandwidth` bytes per second """
+    def __init__(self, data: bytes, bandwidth: int):
+        self.size = len(data)
+        self._buffer = BytesIO(data)
+        self._bandwidth = bandwidth
+        self._start = time.monotonic()
+        self._sent = 0
+    
+    def stream(self):
+        return self
+    
+    def read(self, n: int) -> bytes:
+        chunk = self._buffer.read(n)
+        self._sent += len(chunk)
+        if self._bandwidth > 0:
+            ahead = self._sent / self._bandwidth - (time.monotonic() - self._start)
+            if ahead > 0:
+                time.sleep(ahead)
+        return chunk
+
+
+class FakeContentFeeder:
+    def __init__(self, audio: bytes, latency: float, bandwidth: int):
+        self.audio = audio
+        self.latency = latency
+        self.bandwidth = bandwidth
+    
+    def load(self, content_id, audio_quality_picker, preload, halt_listener):
+        # stands in for the audio key request and CDN negotiation
+        time.sleep(self.latency)
+        return SimpleNamespace(input_stream=FakeAudioStream(self.audio, self.bandwidth))
+
+
+class FakeSession:
+    def __init__(self, feeder: FakeContentFeeder):
+        self.feeder = feeder
+    
+    def content_feeder(self) -> FakeContentFeeder:
+        return self.feeder
+    
+    def tokens(self):
+        def token(*scopes):
+            return SimpleNamespace(access_token='zotify-bench', expires_in=3600, timestamp=time.time_ns() // 1000)
+        return SimpleNamespace(get_token=token, login5=token)
+    
+    def get_user_attribute(self, key: str, fallback: str | None = None) -> str:
+        return 'premium'
+    
+    def username(self) -> str:
+        return 'zotify-bench'
+
+
+# Mock Web API
+class Catalogue:
+    """ Deterministic library where track n belongs to album n // tracks_per_album, whose artist is album // albums_per_artist """
+    def __init__(self, tracks_per_album: int, albums_per_artist: int, playlist_size: int, lyrics_ratio: float):
+        self.base_url = ''
+        self.tracks_per_album = tracks_per_album
+        self.albums_per_artist = albums_per_artist
+        self.playlist_size = playlist_size
+        self.playlist_start = 0
+        self.liked_size = playlist_size
+        self.lyrics_ratio = lyrics_ratio
+    
+    def artist(self, r: int, full: bool = False) -> dict:
+        artist = {ID: make_id('artist', r), NAME: f'Artist {r}'}
+        if full:
+            artist[GENRES] = ['benchcore', f'genre {r % 7}']
+        return artist
+    
+    def track(self, n: int, with_album: bool = True) -> dict:
+        a = n // self.tracks_per_album
+        track = {ID: make_id(TRACK, n), NAME: f'Track {n}', ARTISTS: [self.artist(a // self.albums_per_artist)],
+                 TRACK_NUMBER: n % self.tracks_per_album + 1, DISC_NUMBER: 1, DURATION_MS: 180000, IS_PLAYABLE: True, TYPE: TRACK}
+        if with_album:
+            track[ALBUM] = self.album(a)
+        return track
+    
+    def album(self, a: int, full: bool = False) -> dict:
+        album = {ID: make_id(ALBUM, a), NAME: f'Album {a}', ARTISTS: [self.artist(a // self.albums_per_artist)],
+                 ALBUM_TYPE: 'album', RELEASE_DATE: '2020-01-01', TOTAL_TRACKS: self.tracks_per_album,
+                 IMAGES: [{URL: f'{self.base_url}/image/{make_id(ALBUM, a)}.jpg', WIDTH: 640, 'height': 640}]}
+        if full:
+            album[TRACKS] = self.page(f'/v1/albums/{album[ID]}/tracks', {}, self.album_tracks(a))
+        return album
+    
+    def album_tracks(self, a: int) -> list[dict]:
+        first = a * self.tracks_per_album
+        return [self.track(n, with_album=False) for n in range(first, first + self.tracks_per_album)]
+    
+    def page(self, path: str, query: dict, items: list, default_limit: int = 50) -> dict:
+        offset = int(query.get('offset', 0))
+        limit = int(query.get('limit', default_limit))
+        next_url = None
+        if offset + limit < len(items):
+            next_url = f'{self.base_url}{path}?' + urlencode({**query, 'offset': offset + limit, 'limit': limit})
+        return {ITEMS: items[offset:offset + limit], 'total': len(items), 'offset': offset, 'limit': limit, 'next': next_url}
+    
+    def route(self, path: str, query: dict) -> tuple[int, dict | bytes]:
+        parts = path.strip('/').split('/')
+        ids = query.get('ids', '').split(',')
+        
+        if parts[0] == 'image':
+            return 200, IMAGE
+        if parts[0] == 'lyrics':
+            n = parse_id(parts[-1])
+            if (n * 0.618) % 1 >= self.lyrics_ratio:
+                return 404, {ERROR: {'status': 404, 'message': 'Not Found'}}
+            return 200, {'lyrics': {'syncType': 'UNSYNCED', 'lines': [{'words': f'Line {i} of track {n}'} for i in range(8)]}}
+        
+        if parts[:2] == ['v1', TRACKS]:
+            return 200, {TRACKS: [self.track(parse_id(i)) for i in ids]}
+        if parts[:2] == ['v1', ARTISTS]:
+            if len(parts) == 2:
+                return 200, {ARTISTS: [self.artist(parse_id(i), full=True) for i in ids]}
+            r = parse_id(parts[2])
+            albums = [self.album(a) for a in range(r * self.albums_per_artist, (r + 1) * self.albums_per_artist)]
+            return 200, self.page(path, query, albums)
+        if parts[:2] == ['v1', ALBUMS]:
+            if len(parts) == 2:
+                return 200, {ALBUMS: [self.album(parse_id(i), full=True) for i in ids]}
+            return 200, self.page(path, query, self.album_tracks(parse_id(parts[2])))
+        if parts[:2] == ['v1', 'playlists']:
+            if len(parts) == 3:
+                return 200, {NAME: 'Bench Playlist', OWNER: {DISPLAY_NAME: 'zotify-bench'},
+                             SNAPSHOT_ID: f'{self.playlist_start}-{self.playlist_size}'}
+            items = [{'added_at': f'2020-01-01T00:00:{n % 60:02d}Z', TRACK: self.track(n)}
+                     for n in range(self.playlist_start, self.playlist_size)]
+            return 200, self.page(path, query, items, 100)
+        
+        if parts == ['v1', 'me', TRACKS]:
+            # newest first, one song liked per minute
+            items = [{'added_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(1577836800 + n * 60)), TRACK: self.track(n)}
+                     for n in reversed(range(self.liked_size))]
+            return 200, self.page(path, query, items)
+        
+        return 404, {ERROR: {'status': 404, 'message': f'No bench route for {path}'}}
+
+
+
+class MockAPI(ThreadingHTTPServer):
+    daemon_threads = True
+    
+    def __init__(self, catalogue: Catalogue, latency: float):
+        super().__init__(('127.0.0.1', 0), MockAPIHandler)
+        self.catalogue = catalogue
+        self.latency = latency
+        self.requests_served = 0
+        self.lock = Lock()
+        catalogue.base_url = f'http://127.0.0.1:{self.server_address[1]}'
+
+
+class MockAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests_served += 1
+        time.sleep(self.server.latency)
+        
+        url = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        status, body = self.server.catalogue.route(url.path, query)
+        
+        content_type = 'image/jpeg' if isinstance(body, bytes) else 'application/json'
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+
+
+@contextmanager
+def redirect_requests(base_url: str):
+    """ Sends every request for a real API host to the mock server instead """
+    rewrites = {BASE_URL: f'{base_url}/v1/', LYRICS_URL: f'{base_url}/lyrics/'}
+    original_request = requests.Session.request
+    
+    def request(self, method, url, *args, **kwargs):
+        for remote, local in rewrites.items():
+            if url.startswith(remote):
+                url = local + url[len(remote):]
+                break
+        return original_request(self, method, url, *args, **kwargs)
+    
+    requests.Session.request = request
+    try:
+        yield
+    finally:
+        requests.Session.request = original_request
+
+
+# Scenarios
+def scenario_playlist(args) -> int:
+    from zotify.playlist import download_playlist
+    download_playlist({ID: make_id('playlist', 0), NAME: 'Bench Playlist'})
+    return args.tracks
+
+
+def scenario_discography(args) -> int:
+    from zotify.album import download_artist_albums
+    download_artist_albums(make_id('artist', 0))
+    return args.albums * args.tracks_per_album
+
+
+def scenario_verify_library(args) -> int:
+    from zotify.app import verify_library
+    from zotify.utils import add_to_song_archive
+    
+    # a downloaded library whose files carry no tags yet, so every track gets rewritten
+    root = Path(Zotify.CONFIG.get_root_path())
+    for n in range(args.tracks):
+        a = n // args.tracks_per_album
+        track_path = root / f'Artist {a // args.albums}' / f'Album {a}' / f'{n:06d}_Track {n}.ogg'
+        track_path.parent.mkdir(parents=True, exist_ok=True)
+        track_path.write_bytes(AUDIO)
+        add_to_song_archive(make_id(TRACK, n), track_path.name, f'Artist {a // args.albums}', f'Track {n}')
+    
+    Zotify.TOTAL_API_CALLS = 0
+    verify_library()
+    return args.tracks
+
+
+def scenario_playlist_sync(args) -> int:
+    from zotify.playlist import sync_playlists
+    url = f'https://open.spotify.com/playlist/{make_id("playlist", 0)}'
+    sync_playlists([url])
+    # unchanged, so only the snapshot is fetched
+    sync_playlists([url])
+    
+    # a tenth of the playlist is replaced
+    changed = max(args.tracks // 10, 1)
+    CATALOGUE.playlist_start += changed
+    CATALOGUE.playlist_size += changed
+    sync_playlists([url])
+    return args.tracks + changed
+
+
+def scenario_liked(args) -> int:
+    from zotify.app import download_liked_songs
+    from zotify.serve import reset_run_state
+    download_liked_songs()
+    
+    # a tenth more songs are liked before the next run, which starts as a new serve job would
+    added = max(args.tracks // 10, 1)
+    CATALOGUE.liked_size += added
+    reset_run_state()
+    download_liked_songs()
+    return args.tracks + added
+
+
+SCENARIOS = {
+    'playlist': scenario_playlist,
+    'liked': scenario_liked,
+    'playlist-sync': scenario_playlist_sync,
+    'discography': scenario_discography,
+    'verify-library': scenario_verify_library,
+}
+
+
+def peak_rss_mib() -> float | None:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB everywhere else
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def run_scenario(args) -> None:
+    global AUDIO, IMAGE, CATALOGUE
+    AUDIO = synthetic_ogg(args.track_size * 1024, 180)
+    IMAGE = synthetic_jpeg()
+    
+    workdir = Path(args.workdir) if args.workdir else Path(tempfile.mkdtemp(prefix='zotify-bench-'))
+    workdir.mkdir(parents=True, exist_ok=True)
+    
+    # same shape as the namespace built by __main__, with bench-friendly overrides
+    config_args = {key.lower(): None for key in CONFIG_VALUES}
+    config_args.update(config_location=str(workdir / 'config.json'), debug=False, update_config=False, no_splash=True,
+                       root_path=str(workdir / 'Music'), root_podcast_path=str(workdir / 'Podcasts'),
+                       song_archive_location=str(workdir), cache_location=str(workdir / 'cache'),
+                       credentials_location=str(workdir), bulk_wait_time='0')
+    if not args.verbose:
+        config_args.update({key.lower(): 'False' for key in CONFIG_VALUES
+                            if key.startswith('PRINT_') and key not in {'PRINT_ERRORS', 'PRINT_API_ERRORS'}})
+    for override in args.set:
+        key, _, value = override.partition('=')
+        config_args[key.lower()] = value
+    Zotify.CONFIG.load(argparse.Namespace(**config_args))
+    
+    catalogue = CATALOGUE = Catalogue(args.tracks_per_album, args.albums, args.tracks, args.lyrics_ratio)
+    server = MockAPI(catalogue, args.api_latency / 1000)
+    Thread(target=server.serve_forever, daemon=True).start()
+    
+    Zotify.SESSION = FakeSession(FakeContentFeeder(AUDIO, args.stream_latency / 1000, args.bandwidth * 1024))
+    Zotify.DOWNLOAD_QUALITY = AudioQuality.VERY_HIGH
+    Zotify.TOTAL_API_CALLS = 0
+    
+    with redirect_requests(catalogue.base_url):
+        from zotify.transcode import TranscodePool
+        time_start = time.perf_counter()
+        tracks = SCENARIOS[args.scenario](args)
+        TranscodePool.join()
+        elapsed = time.perf_counter() - time_start
+    server.shutdown()
+    
+    rss = peak_rss_mib()
+    loader_wait = sum(Perf.SAMPLES.get('loader_wait', []))
+    Printer.table(f'ZOTIFY BENCH: {args.scenario.upper()}', ('Metric', 'Value'), [
+        ['Tracks', tracks],
+        ['Elapsed', f'{elapsed:.2f}s'],
+        ['Tracks/sec', f'{tracks / elapsed:.2f}'],
+        ['API calls', Zotify.TOTAL_API_CALLS],
+        ['API calls/track', f'{Zotify.TOTAL_API_CALLS / max(tracks, 1):.2f}'],
+        ['HTTP requests served', server.requests_served],
+        ['Loader wait/track', f'{loader_wait / max(tracks, 1) * 1000:.1f}ms'],
+        ['Headless', Zotify.CONFIG.get_headless()],
+        ['Peak RSS', f'{rss:.1f} MiB' if rss is not None else 'n/a'],
+        ['Work directory', str(workdir)],
+    ])
+    Perf.print_report()
+    
+    if args.result_file:
+        with open(args.result_file, 'w', encoding='utf-8') as file:
+            json.dump({'tracks': tracks, 'elapsed': elapsed, 'loader_wait': loader_wait}, file)
+
+
+def compare_headless(args) -> None:
+    """ Runs the scenario once with terminal output and once headless, each in a fresh process and work directory """
+    workdir = Path(args.workdir) if args.workdir else Path(tempfile.mkdtemp(prefix='zotify-bench-'))
+    results = {}
+    for headless in (False, True):
+        mode = 'headless' if headless else 'terminal'
+        result_file = workdir / f'{mode}.json'
+        command = [sys.executable, '-m', 'zotify.bench', *[a for a in sys.argv[1:] if a != '--compare-headless'],
+                   '--workdir', str(workdir / mode), '--result-file', str(result_file), '--set', f'HEADLESS={headless}']
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL if not args.verbose else None)
+        results[mode] = json.loads(result_file.read_text(encoding='utf-8'))
+    
+    rows = []
+    for mode, result in results.items():
+        rows.append([mode, result['tracks'], f"{result['elapsed']:.2f}s", f"{result['tracks'] / result['elapsed']:.2f}",
+                     f"{result['elapsed'] / max(result['tracks'], 1) * 1000:.1f}ms",
+                     f"{result['loader_wait'] / max(result['tracks'], 1) * 1000:.1f}ms"])
+    per_track = {mode: result['elapsed'] / max(result['tracks'], 1) for mode, result in results.items()}
+    Printer.table(f'ZOTIFY BENCH: {args.scenario.upper()} OUTPUT MODES',
+                  ('Mode', 'Tracks', 'Elapsed', 'Tracks/sec', 'Time/track', 'Loader wait/track'), rows)
+    Printer.hashtaged(PrintChannel.MANDATORY, f"HEADLESS SAVED {(per_track['terminal'] - per_track['headless']) * 1000:.1f}ms PER TRACK")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='zotify-bench',
+        description='Benchmark Zotify against a local mock of the Web API and a fake content feeder.')
+    
+    parser.add_argument('scenario',
+                        choices=SCENARIOS.keys(),
+                        help='Scenario to run')
+    parser.add_argument('--tracks',
+                        type=int,
+                        default=10000,
+                        help='Tracks in the playlist or synthetic library')
+    parser.add_argument('--albums',
+                        type=int,
+                        default=200,
+                        help='Albums in the artist\'s discography')
+    parser.add_argument('--tracks-per-album',
+                        type=int,
+                        default=12,
+                        help='Tracks on every album')
+    parser.add_argument('--track-size',
+                        type=int,
+                        default=1024,
+                        help='Size of each synthetic audio file in KiB')
+    parser.add_argument('--api-latency',
+                        type=float,
+                        default=20,
+                        help='Added latency per Web API request in milliseconds')
+    parser.add_argument('--stream-latency',
+                        type=float,
+                        default=50,
+                        help='Added latency per content stream load in milliseconds')
+    parser.add_argument('--bandwidth',
+                        type=int,
+                        default=0,
+                        help='Content stream bandwidth in KiB/s, 0 for unlimited')
+    parser.add_argument('--lyrics-ratio',
+                        type=float,
+                        default=1.0,
+                        help='Fraction of tracks that have lyrics, the rest return 404')
+    parser.add_argument('--workdir',
+                        type=str,
+                        help='Directory for the config, library and archives (defaults to a new temporary directory)')
+    parser.add_argument('--set',
+                        action='append',
+                        default=[],
+                        metavar='KEY=VALUE',
+                        help='Override a config value, e.g. --set TRANSCODE_WORKERS=4')
+    parser.add_argument('--verbose',
+                        action='store_true',
+                        help='Keep Zotify\'s regular terminal output')
+    parser.add_argument('--compare-headless',
+                        action='store_true',
+                        help='Run the scenario with terminal output and headless, and report the per-track difference')
+    parser.add_argument('--result-file',
+                        type=str,
+                        help=argparse.SUPPRESS)
+    
+    args = parser.parse_args()
+    if args.compare_headless:
+        compare_headless(args)
+    else:
+        run_scenario(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+import hashlib
+import json
+import time
+import requests
+from collections import OrderedDict
+from io import BytesIO
+from pathlib import Path
+from threading import Lock, RLock
+from PIL import Image
+
+from zotify.config import Zotify
+from zotify.const import ID, LYRICS
+
+
+class ArtworkCache:
+    """
+    Content-addressed album artwork cache
+    
+    Images are stored on disk by the SHA-256 of their bytes, with an index mapping each image URL to its digest,
+    so identical covers served from different URLs share a single file. Recently used images are also held in memory.
+    """
+    MEMORY: OrderedDict[str, bytes] = OrderedDict()
+    MEMORY_SIZE = 32
+    INDEX: dict[str, str] | None = None
+    FETCHING: dict[str, Lock] = {}
+    TIMEOUT = 30
+    LOCK = RLock()
+    
+    @classmethod
+    def _cache_dir(cls) -> Path | None:
+        if not Zotify.CONFIG.get_artwork_cache():
+            return None
+        cache_dir = Path(Zotify.CONFIG.get_cache_location() / 'artwork')
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        return cache_dir
+    
+    @classmethod
+    def _load_index(cls, cache_dir: Path) -> dict[str, str]:
+        if cls.INDEX is None:
+            cls.INDEX = {}
+            index_path = cache_dir / 'index'
+            if index_path.exists():
+                with open(index_path, 'r', encoding='utf-8') as file:
+                    for line in file:
+                        url, _, digest = line.strip().partition('\t')
+                        if digest:
+                            cls.INDEX[url] = digest
+        return cls.INDEX
+    
+    @classmethod
+    def _remember(cls, key: str, img: bytes) -> bytes:
+        cls.MEMORY[key] = img
+        cls.MEMORY.move_to_end(key)
+        while len(cls.MEMORY) > cls.MEMORY_SIZE:
+            cls.MEMORY.popitem(last=False)
+        return img
+    
+    @classmethod
+    def _lookup(cls, image_url: str) -> bytes | None:
+        """ Returns the image from memory or disk, must be called holding LOCK """
+        if image_url in cls.MEMORY:
+            cls.MEMORY.move_to_end(image_url)
+            return cls.MEMORY[image_url]
+        
+        cache_dir = cls._cache_dir()
+        if cache_dir is not None:
+            digest = cls._load_index(cache_dir).get(image_url)
+            if digest and (cache_dir / f'{digest}.jpg').is_file():
+                return cls._remember(image_url, (cache_dir / f'{digest}.jpg').read_bytes())
+        return None
+    
+    @classmethod
+    def get(cls, image_url: str) -> bytes:
+        """ Returns the image at `image_url`, fetching it only if it is not already cached """
+        with cls.LOCK:
+            img = cls._lookup(image_url)
+            if img is not None:
+                return img
+            fetch_lock = cls.FETCHING.setdefault(image_url, Lock())
+        
+        # only requests for the same URL wait on each other, the cache stays available during the fetch
+        with fetch_lock:
+            with cls.LOCK:
+                img = cls._lookup(image_url)
+                if img is not None:
+                    return img
+            
+            try:
+                resp = requests.get(image_url, timeout=cls.TIMEOUT)
+                resp.raise_for_status()
+                img = resp.content
+                
+                with cls.LOCK:
+                    cache_dir = cls._cache_dir()
+                    if cache_dir is not None:
+                        digest = hashlib.sha256(img).hexdigest()
+                        blob_path = cache_dir / f'{digest}.jpg'
+                        if not blob_path.exists():
+                            # write then rename, so an interrupted run never leaves a truncated image behind
+                            temp_path = blob_path.with_suffix('.part')
+                            temp_path.write_bytes(img)
+                            temp_path.replace(blob_path)
+                        with open(cache_dir / 'index', 'a', encoding='utf-8') as file:
+                            file.write(f'{image_url}\t{digest}\n')
+                        cls._load_index(cache_dir)[image_url] = digest
+                    
+                    return cls._remember(image_url, img)
+            finally:
+                with cls.LOCK:
+                    cls.FETCHING.pop(image_url, None)
+    
+    @classmethod
+    def get_variant(cls, image_url: str, max_size: int, quality: int) -> bytes:
+        """ Returns the image at `image_url` downscaled to fit within `max_size` pixels, reusing previously encoded variants """
+        img = cls.get(image_url)
+        if max_size <= 0:
+            return img
+        
+        key = f'{image_url}#{max_size}q{quality}'
+        with cls.LOCK:
+            if key in cls.MEMORY:
+                cls.MEMORY.move_to_end(key)
+                return cls.MEMORY[key]
+            
+            cache_dir = cls._cache_dir()
+            variant_path = None
+            if cache_dir is not None:
+                variant_path = cache_dir / f'{hashlib.sha256(img).hexdigest()}_{max_size}q{quality}.jpg'
+                if variant_path.is_file():
+                    return cls._remember(key, variant_path.read_bytes())
+            
+            with Image.open(BytesIO(img)) as image:
+                if max(image.size) <= max_size:
+                    # already small enough, re-encoding would only lose quality
+                    return cls._remember(key, img)
+                image = image.convert('RGB')
+                image.thumbnail((max_size, max_size), Image.LANCZOS)
+                buffer = BytesIO()
+                image.save(buffer, format='JPEG', quality=quality, optimize=True)
+            variant = buffer.getvalue()
+            
+            if variant_path is not None:
+                temp_path = variant_path.with_suffix('.part')
+                temp_path.write_bytes(variant)
+                temp_path.replace(variant_path)
+            
+            return cls._remember(key, variant)
+
+
+class LyricsCache:
+    """
+    Persistent lyrics lookup cache
+    
+    Both fetched lyrics and "not available" results are stored with the time they were fetched,
+    so tracks without lyrics are not re-queried on every run until the entry expires.
+    """
+    ENTRIES: dict[str, tuple[float, list[str] | None]] | None = None
+    LOCK = RLock()
+    
+    @classmethod
+    def _ttl(cls) -> float:
+        return Zotify.CONFIG.get_lyrics_cache_ttl() * 86400
+    
+    @classmethod
+    def _cache_path(cls) -> Path:
+        return Path(Zotify.CONFIG.get_cache_location() / 'lyrics.jsonl')
+    
+    @classmethod
+    def _load(cls) -> dict[str, tuple[float, list[str] | None]]:
+        if cls.ENTRIES is None:
+            cls.ENTRIES = {}
+            cache_path = cls._cache_path()
+            if not cache_path.exists():
+                return cls.ENTRIES
+            
+            lines = 0
+            with open(cache_path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    lines += 1
+                    try:
+                        entry = json.loads(line)
+                        cls.ENTRIES[entry[ID]] = (entry['fetched'], entry[LYRICS])
+                    except (ValueError, KeyError):
+                        continue # partially written line from an interrupted run
+            
+            # drop expired and superseded entries once they make up most of the file
+            now = time.time()
+            fresh = {k: v for k, v in cls.ENTRIES.items() if now - v[0] < cls._ttl()}
+            if lines > 2 * len(fresh) + 100:
+                cls.ENTRIES = fresh
+                temp_path = cache_path.with_suffix('.part')
+                with open(temp_path, 'w', encoding='utf-8') as file:
+                    for track_id, (fetched, lyrics) in fresh.items():
+                        file.write(json.dumps({ID: track_id, 'fetched': fetched, LYRICS: lyrics}) + '\n')
+                temp_path.replace(cache_path)
+        return cls.ENTRIES
+    
+    @classmethod
+    def get(cls, track_id: str) -> tuple[bool, list[str] | None]:
+        """ Returns (True, lyrics) for an unexpired entry, where lyrics is None if none were available, else (False, None) """
+        if cls._ttl() <= 0:
+            return False, None
+        
+        with cls.LOCK:
+            entry = cls._load().get(track_id)
+        if entry is None or time.time() - entry[0] >= cls._ttl():
+            return False, None
+        return True, entry[1]
+    
+    @classmethod
+    def put(cls, track_id: str, lyrics: list[str] | None) -> None:
+        if cls._ttl() <= 0:
+            return
+        
+        with cls.LOCK:
+            fetched = time.time()
+            cls._load()[track_id] = (fetched, lyrics)
+            with open(cls._cache_path(), 'a', encoding='utf-8') as file:
+                file.write(json.dumps({ID: track_id, 'fetched': fetched, LYRICS: lyrics}) + '\n')
@@ -4,6 +4,7 @@ import json
 import base64
 import sys
 import re
+import time
 import requests
 from librespot.audio.decoders import VorbisOnlyAudioQuality
 from librespot.core import Session, OAuth
@@ -11,10 +12,12 @@ from librespot.core import Session, OAuth
 from librespot.mercury import MercuryRequests
 from librespot.proto.Authentication_pb2 import AuthenticationType
 from pathlib import Path, PurePath
-from time import sleep
+from threading import Event, Lock, Thread
 from typing import Any, Callable
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 
 from zotify.const import *
+from zotify.perf import Perf
 from zotify.termoutput import Printer, PrintChannel, Loader
 
 
@@ -51,6 +54,9 @@ CONFIG_VALUES = {
     TEMP_DOWNLOAD_DIR:          { 'default': '',                        'type': str,    'arg': ('-td', '--temp-download-dir'             ,) },
     DOWNLOAD_PARENT_ALBUM:      { 'default': 'False',                   'type': bool,   'arg': ('--download-parent-album'                ,) },
     NO_COMPILATION_ALBUMS:      { 'default': 'False',                   'type': bool,   'arg': ('--no-compilation-albums'                ,) },
+    PODCAST_DOWNLOAD_WORKERS:   { 'default': '1',                       'type': int,    'arg': ('--podcast-download-workers'             ,) },
+    DIRECT_DOWNLOAD_CONNECTIONS:{ 'default': '4',                       'type': int,    'arg': ('--direct-download-connections'          ,) },
+    SYNC_INTERVAL:              { 'default': '0',                       'type': int,    'arg': ('--sync-interval'                        ,) },
     
     # Regex Options
     REGEX_ENABLED:              { 'default': 'False',                   'type': bool,   'arg': ('--regex-enabled'                        ,) },
@@ -62,6 +68,8 @@ CONFIG_VALUES = {
     DOWNLOAD_FORMAT:            { 'default': 'copy',                    'type': str,    'arg': ('--codec', '--download-format'           ,) },
     DOWNLOAD_QUALITY:           { 'default': 'auto',                    'type': str,    'arg': ('-q', '--download-quality'               ,) },
     TRANSCODE_BITRATE:          { 'default': 'auto',                    'type': str,    'arg': ('-b', '--bitrate', '--transcode-bitrate' ,) },
+    STREAM_TRANSCODE:           { 'default': 'False',                   'type': bool,   'arg': ('--stream-transcode'                     ,) },
+    TRANSCODE_WORKERS:          { 'default': '1',                       'type': int,    'arg': ('--transcode-workers'                    ,) },
     
     # Archive Options
     SONG_ARCHIVE_LOCATION:      { 'default': '',                        'type': str,    'arg': ('--song-archive-location'                ,) },
@@ -70,6 +78,12 @@ CONFIG_VALUES = {
     SKIP_EXISTING:              { 'default': 'True',                    'type': bool,   'arg': ('-ie', '--skip-existing'                 ,) },
     SKIP_PREVIOUSLY_DOWNLOADED: { 'default': 'False',                   'type': bool,   'arg': ('-ip', '--skip-prev-downloaded', 
                                                                                                 '--skip-previously-downloaded'           ,) },
+    INCREMENTAL_LIKED_SONGS:    { 'default': 'False',                   'type': bool,   'arg': ('--incremental-liked-songs'              ,) },
+    
+    # Cache Options
+    CACHE_LOCATION:             { 'default': '',                        'type': str,    'arg': ('--cache-location'                       ,) },
+    ARTWORK_CACHE:              { 'default': 'True',                    'type': bool,   'arg': ('--artwork-cache'                        ,) },
+    LYRICS_CACHE_TTL:           { 'default': '30',                      'type': int,    'arg': ('--lyrics-cache-ttl'                     ,) },
     
     # Playlist File Options
     EXPORT_M3U8:                { 'default': 'False',                   'type': bool,   'arg': ('-e, --export-m3u8'                      ,) },
@@ -93,14 +107,19 @@ CONFIG_VALUES = {
     MD_ARTISTDELIMITER:         { 'default': ', ',                      'type': str,    'arg': ('--md-artistdelimiter'                   ,) },
     MD_SAVE_LYRICS:             { 'default': 'True',                    'type': bool,   'arg': ('--md-save-lyrics'                       ,) },
     ALBUM_ART_JPG_FILE:         { 'default': 'False',                   'type': bool,   'arg': ('--album-art-jpg-file'                   ,) },
+    ALBUM_ART_MAX_SIZE:         { 'default': '0',                       'type': int,    'arg': ('--album-art-max-size'                   ,) },
+    ALBUM_ART_QUALITY:          { 'default': '90',                      'type': int,    'arg': ('--album-art-quality'                    ,) },
     
     # API Options
     RETRY_ATTEMPTS:             { 'default': '1',                       'type': int,    'arg': ('--retry-attempts'                       ,) },
     CHUNK_SIZE:                 { 'default': '20000',                   'type': int,    'arg': ('--chunk-size'                           ,) },
     REDIRECT_ADDRESS:           { 'default': '127.0.0.1',               'type': str,    'arg': ('--redirect-address'                     ,) },
     LISTEN_ADDRESS:             { 'default': '0.0.0.0',                 'type': str,    'arg': ('--listen-address'                       ,) },
+    SERVE_PORT:                 { 'default': '4382',                    'type': int,    'arg': ('--serve-port'                           ,) },
+    SERVE_ADDRESS:              { 'default': '127.0.0.1',               'type': str,    'arg': ('--serve-address'                        ,) },
     
     # Terminal & Logging Options
+    HEADLESS:                   { 'default': 'auto',                    'type': str,    'arg': ('--headless'                             ,) },
     PRINT_SPLASH:               { 'default': 'False',                   'type': bool,   'arg': ('--print-splash'                         ,) },
     PRINT_PROGRESS_INFO:        { 'default': 'True',                    'type': bool,   'arg': ('--print-progress-info'                  ,) },
     PRINT_SKIPS:                { 'default': 'True',                    'type': bool,   'arg': ('--print-skips'                          ,) },
@@ -114,6 +133,12 @@ CONFIG_VALUES = {
     PRINT_ERRORS:               { 'default': 'True',                    'type': bool,   'arg': ('--print-errors'                         ,) },
     PRINT_API_ERRORS:           { 'default': 'True',                    'type': bool,   'arg': ('--print-api-errors'                     ,) },
     FFMPEG_LOG_LEVEL:           { 'default': 'error',                   'type': str,    'arg': ('--ffmpeg-log-level'                     ,) },
+    PRINT_PERF_REPORT:          { 'default': 'False',                   'type': bool,   'arg': ('--print-perf-report'                    ,) },
+    PERF_REPORT_FILE:           { 'default': '',                        'type': str,    'arg': ('--perf-report-file'                     ,) },
+    METRICS_PORT:               { 'default': '0',                       'type': int,    'arg': ('--metrics-port'                         ,) },
+    METRICS_ADDRESS:            { 'default': '127.0.0.1',               'type': str,    'arg': ('--metrics-address'                      ,) },
+    METRICS_TEXTFILE:           { 'default': '',                        'type': str,    'arg': ('--metrics-textfile'                     ,) },
+    EVENT_LOG:                  { 'default': '',                        'type': str,    'arg': ('--event-log'                            ,) },
 }  
 
 
@@ -212,6 +237,10 @@ class Config:
         # Check no-splash
         if args.no_splash:
             cls.Values[PRINT_SPLASH] = False
+        
+        # Resolve headless output, automatic when stdout is piped or redirected
+        headless = str(cls.Values[HEADLESS]).lower()
+        cls.Values[HEADLESS] = not sys.stdout.isatty() if headless == 'auto' else headless in ['yes', 'true', '1']
     
     @classmethod
     def get_default_json(cls) -> dict:
@@ -283,6 +312,10 @@ class Config:
     def get_skip_previously_downloaded(cls) -> bool:
         return cls.get(SKIP_PREVIOUSLY_DOWNLOADED)
     
+    @classmethod
+    def get_incremental_liked_songs(cls) -> bool:
+        return cls.get(INCREMENTAL_LIKED_SONGS)
+    
     @classmethod
     def get_split_album_discs(cls) -> bool:
         return cls.get(SPLIT_ALBUM_DISCS)
@@ -319,6 +352,14 @@ class Config:
     def get_transcode_bitrate(cls) -> str:
         return cls.get(TRANSCODE_BITRATE)
     
+    @classmethod
+    def get_stream_transcode(cls) -> bool:
+        return cls.get(STREAM_TRANSCODE)
+    
+    @classmethod
+    def get_transcode_workers(cls) -> int:
+        return cls.get(TRANSCODE_WORKERS)
+    
     @classmethod
     def get_song_archive_location(cls) -> PurePath:
         if cls.get(SONG_ARCHIVE_LOCATION) == '':
@@ -339,6 +380,46 @@ class Config:
         Path(song_archive.parent).mkdir(parents=True, exist_ok=True)
         return song_archive
     
+    @classmethod
+    def get_podcast_archive_location(cls) -> PurePath:
+        return cls.get_song_archive_location().parent / '.podcast_archive'
+    
+    @classmethod
+    def get_liked_songs_state_location(cls) -> PurePath:
+        return cls.get_song_archive_location().parent / '.liked_songs_state.json'
+    
+    @classmethod
+    def get_playlist_sync_location(cls) -> PurePath:
+        return cls.get_song_archive_location().parent / '.playlist_sync.json'
+    
+    @classmethod
+    def get_cache_location(cls) -> PurePath:
+        if cls.get(CACHE_LOCATION) == '':
+            system_paths = {
+                'win32': Path.home() / 'AppData/Local/Zotify/Cache',
+                'linux': Path.home() / '.cache/zotify',
+                'darwin': Path.home() / 'Library/Caches/Zotify'
+            }
+            if sys.platform not in system_paths:
+                cache =  PurePath(Path.cwd() / '.zotify/cache')
+            else:
+                cache = PurePath(system_paths[sys.platform])
+        else:
+            cache_path: str = cls.get(CACHE_LOCATION)
+            if cache_path[0] == ".":
+                cache_path = cls.get_root_path() / PurePath(cache_path).relative_to(".")
+            cache = PurePath(Path(cache_path).expanduser())
+        Path(cache).mkdir(parents=True, exist_ok=True)
+        return cache
+    
+    @classmethod
+    def get_artwork_cache(cls) -> bool:
+        return cls.get(ARTWORK_CACHE)
+    
+    @classmethod
+    def get_lyrics_cache_ttl(cls) -> int:
+        return cls.get(LYRICS_CACHE_TTL)
+    
     @classmethod
     def get_save_credentials(cls) -> bool:
         return cls.get(SAVE_CREDENTIALS)
@@ -454,6 +535,10 @@ class Config:
                              f'SELECT FROM: {valid_levels}')
         return level
     
+    @classmethod
+    def get_headless(cls) -> bool:
+        return cls.get(HEADLESS)
+    
     @classmethod
     def get_show_download_pbar(cls) -> bool:
         return cls.get(PRINT_DOWNLOAD_PROGRESS)
@@ -492,6 +577,18 @@ class Config:
     def get_album_art_jpg_file(cls) -> bool:
         return cls.get(ALBUM_ART_JPG_FILE)
     
+    @classmethod
+    def get_album_art_max_size(cls) -> int:
+        return cls.get(ALBUM_ART_MAX_SIZE)
+    
+    @classmethod
+    def get_album_art_quality(cls) -> int:
+        quality = cls.get(ALBUM_ART_QUALITY)
+        if not 1 <= quality <= 95:
+            raise ValueError(f'ALBUM ART QUALITY "{quality}" NOT VALID\n' +\
+                              'SELECT A VALUE FROM 1 TO 95')
+        return quality
+    
     @classmethod
     def get_max_filename_length(cls) -> int:
         return cls.get(MAX_FILENAME_LENGTH)
@@ -525,6 +622,18 @@ class Config:
     def get_download_parent_album(cls) -> bool:
         return cls.get(DOWNLOAD_PARENT_ALBUM)
     
+    @classmethod
+    def get_podcast_download_workers(cls) -> int:
+        return max(cls.get(PODCAST_DOWNLOAD_WORKERS), 1)
+    
+    @classmethod
+    def get_direct_download_connections(cls) -> int:
+        return max(cls.get(DIRECT_DOWNLOAD_CONNECTIONS), 1)
+    
+    @classmethod
+    def get_sync_interval(cls) -> int:
+        return max(cls.get(SYNC_INTERVAL), 0)
+    
     @classmethod
     def get_oauth_address(cls) -> tuple[str, str]:
         redirect_address = cls.get(REDIRECT_ADDRESS)
@@ -539,6 +648,18 @@ class Config:
             return listen_address
         return '0.0.0.0'
     
+    @classmethod
+    def get_serve_port(cls) -> int:
+        return cls.get(SERVE_PORT)
+    
+    @classmethod
+    def get_serve_address(cls) -> str:
+        return cls.get(SERVE_ADDRESS)
+    
+    @classmethod
+    def get_serve_queue_location(cls) -> PurePath:
+        return cls.get_song_archive_location().parent / '.serve_queue.json'
+    
     @classmethod
     def get_skip_comp_albums(cls) -> bool:
         return cls.get(NO_COMPILATION_ALBUMS)
@@ -572,13 +693,57 @@ class Config:
     @classmethod
     def get_strict_library_verify(cls) -> bool:
         return cls.get(STRICT_LIBRARY_VERIFY)
+    
+    @classmethod
+    def get_print_perf_report(cls) -> bool:
+        return cls.get(PRINT_PERF_REPORT)
+    
+    @classmethod
+    def get_perf_report_file(cls) -> PurePath | None:
+        if cls.get(PERF_REPORT_FILE) == '':
+            return None
+        perf_report_path: str = cls.get(PERF_REPORT_FILE)
+        if perf_report_path[0] == ".":
+            perf_report_path = cls.get_root_path() / PurePath(perf_report_path).relative_to(".")
+        return PurePath(Path(perf_report_path).expanduser())
+    
+    @classmethod
+    def get_metrics_port(cls) -> int:
+        return cls.get(METRICS_PORT)
+    
+    @classmethod
+    def get_metrics_address(cls) -> str:
+        return cls.get(METRICS_ADDRESS)
+    
+    @classmethod
+    def get_metrics_textfile(cls) -> PurePath | None:
+        if cls.get(METRICS_TEXTFILE) == '':
+            return None
+        metrics_textfile: str = cls.get(METRICS_TEXTFILE)
+        if metrics_textfile[0] == ".":
+            metrics_textfile = cls.get_root_path() / PurePath(metrics_textfile).relative_to(".")
+        return PurePath(Path(metrics_textfile).expanduser())
+    
+    @classmethod
+    def get_event_log(cls) -> PurePath | str | None:
+        event_log: str = cls.get(EVENT_LOG)
+        if event_log in {'', '-'}:
+            return event_log or None
+        if event_log[0] == ".":
+            event_log = cls.get_root_path() / PurePath(event_log).relative_to(".")
+        return PurePath(Path(event_log).expanduser())
 
 
 class Zotify:    
     SESSION: Session = None
     DOWNLOAD_QUALITY = None
     TOTAL_API_CALLS = 0
+    API_CALLS_LOCK = Lock()
+    FFMPEG_SKIPS = 0
+    FFMPEG_SKIPPED_BYTES = 0
     DATETIME_LAUNCH = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    LIKED_M3U8_CREATED = False
+    LIKED_M3U8_MERGED = False
     CONFIG: Config = Config()
     
     def __init__(self, args):
@@ -643,21 +808,75 @@ class Zotify:
             else:        
                 raise e
     
-    @classmethod
-    def __get_auth_token(cls):
-        return cls.SESSION.tokens().get_token(
-            USER_READ_EMAIL, PLAYLIST_READ_PRIVATE, USER_LIBRARY_READ, USER_FOLLOW_READ
-        ).access_token
-    
-    @classmethod
-    def get_auth_header(cls):
-        return {
-            'Authorization': f'Bearer {cls.__get_auth_token()}',
+    AUTH_SCOPES = [USER_READ_EMAIL, PLAYLIST_READ_PRIVATE, USER_LIBRARY_READ, USER_FOLLOW_READ]
+    AUTH_REFRESH_MARGIN = 300
+    AUTH_RETRY_WAIT = 30
+    AUTH_HEADER: dict[str, str] | None = None
+    AUTH_EXPIRES = 0.0
+    AUTH_LOCK = Lock()
+    AUTH_STOP = Event()
+    AUTH_REFRESHER: Thread | None = None
+    
+    @classmethod
+    def __fetch_auth_header(cls, fresh: bool = False) -> tuple[dict[str, str], float]:
+        """ Returns a new auth header and the time.monotonic() deadline its token expires at """
+        tokens = cls.SESSION.tokens()
+        with Perf.timer('auth_token'):
+            # librespot hands back its cached token until seconds before expiry, login5 always issues a new one
+            token = tokens.login5(cls.AUTH_SCOPES) if fresh else None
+            if token is None:
+                token = tokens.get_token(*cls.AUTH_SCOPES)
+        # a cached token has already used up part of its lifetime
+        remaining = token.expires_in - (time.time() - token.timestamp / 1_000_000)
+        header = {
+            'Authorization': f'Bearer {token.access_token}',
             'Accept-Language': f'{cls.CONFIG.get_language()}',
             'Accept': 'application/json',
             'app-platform': 'WebPlayer',
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:136.0) Gecko/20100101 Firefox/136.0'
         }
+        return header, time.monotonic() + remaining
+    
+    @classmethod
+    def __refresh_auth_loop(cls) -> None:
+        wait = max(cls.AUTH_EXPIRES - cls.AUTH_REFRESH_MARGIN - time.monotonic(), 0)
+        while not cls.AUTH_STOP.wait(wait):
+            try:
+                header, expires = cls.__fetch_auth_header(fresh=True)
+            except Exception as e:
+                # the current token stays in use, get_auth_header takes over if it runs out
+                Printer.hashtaged(PrintChannel.WARNING, f'FAILED TO REFRESH ACCESS TOKEN - RETRYING\n{e}')
+                wait = cls.AUTH_RETRY_WAIT
+                continue
+            with cls.AUTH_LOCK:
+                cls.AUTH_HEADER, cls.AUTH_EXPIRES = header, expires
+            wait = max(expires - cls.AUTH_REFRESH_MARGIN - time.monotonic(), cls.AUTH_RETRY_WAIT)
+    
+    @classmethod
+    def get_auth_header(cls) -> dict[str, str]:
+        """ Returns the cached auth header, which is shared and must not be modified
+        
+        A background thread swaps in a new token shortly before the current one expires, so
+        the token is only fetched here on first use or after the cache was invalidated. """
+        header = cls.AUTH_HEADER
+        if header is not None and time.monotonic() < cls.AUTH_EXPIRES:
+            return header
+        
+        with cls.AUTH_LOCK:
+            # another worker may have fetched it while this one waited for the lock
+            if cls.AUTH_HEADER is None or time.monotonic() >= cls.AUTH_EXPIRES:
+                cls.AUTH_HEADER, cls.AUTH_EXPIRES = cls.__fetch_auth_header(fresh=cls.AUTH_HEADER is not None)
+            if cls.AUTH_REFRESHER is None:
+                cls.AUTH_REFRESHER = Thread(target=cls.__refresh_auth_loop, daemon=True, name="zotify-auth-refresh")
+                cls.AUTH_REFRESHER.start()
+            return cls.AUTH_HEADER
+    
+    @classmethod
+    def invalidate_auth_header(cls, header: dict[str, str]) -> None:
+        """ Drops `header` from the cache after the API rejected it, unless it was already replaced """
+        with cls.AUTH_LOCK:
+            if cls.AUTH_HEADER is header:
+                cls.AUTH_EXPIRES = 0.0
     
     @classmethod
     def invoke_url(cls, url: str, _params: dict | None = None, expectFail: bool = False) -> tuple[str, dict]:
@@ -665,8 +884,10 @@ class Zotify:
         
         tryCount = 0
         while tryCount <= cls.CONFIG.get_retry_attempts():
-            response = requests.get(url, headers=headers, params=_params)
-            cls.TOTAL_API_CALLS += 1
+            with Perf.timer('api'):
+                response = requests.get(url, headers=headers, params=_params)
+            with cls.API_CALLS_LOCK:
+                cls.TOTAL_API_CALLS += 1
             
             try:
                 responsetext = response.text
@@ -675,13 +896,18 @@ class Zotify:
                     raise json.decoder.JSONDecodeError
                 # responsejson = {"error": {"status": "Unknown", "message": "Received an empty response"}}
             except json.decoder.JSONDecodeError:
-                responsejson = {"error": {"status": "Unknown", "message": "Received an empty response"}}
+                responsejson = {"error": {"status": response.status_code, "message": "Received an empty response"}}
             
             if not responsejson or 'error' in responsejson:
+                Perf.count(f'api_errors:{responsejson["error"]["status"]}')
+                if response.status_code == 401:
+                    # token revoked or expired early, retry with a fresh one
+                    cls.invalidate_auth_header(headers)
+                    headers = cls.get_auth_header()
                 if not expectFail: 
                     Printer.hashtaged(PrintChannel.WARNING, f'API ERROR (TRY {tryCount}) - RETRYING\n' +\
                                                             f'{responsejson["error"]["status"]}: {responsejson["error"]["message"]}')
-                sleep(5 if not expectFail else 1)
+                Perf.sleep(5 if not expectFail else 1, 'api_retry_wait')
                 tryCount += 1
                 continue
             else:
@@ -702,21 +928,49 @@ class Zotify:
         return responsejson
     
     @classmethod
-    def invoke_url_nextable(cls, url: str, response_key: str = ITEMS, limit: int = 50, stripper: str | None = None, offset: int = 0) -> list[dict]:
+    def invoke_url_nextable(cls, url: str, response_key: str = ITEMS, limit: int = 50, stripper: str | None = None, offset: int = 0,
+                            stop: Callable[[dict], bool] | None = None) -> list[dict]:
         resp = cls.invoke_url_with_params(url, limit=limit, offset=offset)
         if stripper is not None:
             resp = resp.get(stripper, resp)
         if response_key not in resp:
             Printer.hashtaged(PrintChannel.WARNING, f'Key "{response_key}" not found in API response: {resp}')
             return []
-        items: list = resp[response_key]
-    
-        while resp.get('next') is not None:
-            _, resp = Zotify.invoke_url(resp['next'])
+        # fields and market filters must carry over to every page
+        params = dict(parse_qsl(urlsplit(url).query))
+        return cls.invoke_url_next_pages(resp, response_key, stop, params)
+    
+    @staticmethod
+    def merge_url_params(url: str, params: dict[str, str]) -> str:
+        """ Adds `params` to the query of `url`, keeping any values it already has """
+        parts = urlsplit(url)
+        query = dict(parse_qsl(parts.query))
+        for key, value in params.items():
+            query.setdefault(key, value)
+        return urlunsplit(parts._replace(query=urlencode(query, safe='(),')))
+    
+    @classmethod
+    def invoke_url_next_pages(cls, resp: dict, response_key: str = ITEMS, stop: Callable[[dict], bool] | None = None,
+                              params: dict[str, str] | None = None) -> list[dict]:
+        """ Returns the items of an already fetched paging object along with those of all following pages,
+        stopping before the first item `stop` returns True for without requesting any further pages """
+        items: list = []
+        
+        while True:
+            page: list = resp[response_key]
+            if stop is not None:
+                for i, item in enumerate(page):
+                    if stop(item):
+                        return items + page[:i]
+            items.extend(page)
+            
+            if resp.get('next') is None:
+                break
+            next_url = cls.merge_url_params(resp['next'], params) if params else resp['next']
+            _, resp = Zotify.invoke_url(next_url)
             if response_key not in resp:
                 Printer.hashtaged(PrintChannel.WARNING, f'Key "{response_key}" not found in paginated API response: {resp}')
                 break
-            items.extend(resp[response_key])
         return items
     
     @classmethod
@@ -54,6 +54,7 @@ LABEL = 'label'
 LINES = 'lines'
 LINE_SYNCED = 'LINE_SYNCED'
 LIMIT = 'limit'
+LINKED_FROM = 'linked_from'
 NAME = 'name'
 NEXT = 'next'
 OFFSET = 'offset'
@@ -88,24 +89,29 @@ BASE_URL = 'https://api.sp' + 'otify.com/v1/'
 BULK_APPEND = 'ids='
 MARKET_APPEND = 'market=from_token'
 ALBUM_URL = BASE_URL + ALBUMS
-ALBUM_BULK_URL = ALBUM_URL + '?' + BULK_APPEND
+ALBUM_BULK_URL = ALBUM_URL + '?' + MARKET_APPEND + '&' + BULK_APPEND
 ARTIST_URL = BASE_URL + ARTISTS
 ARTIST_BULK_URL = ARTIST_URL + '?' + BULK_APPEND
 AUDIOBOOK_URL = BASE_URL + AUDIOBOOK
 CHAPTER_URL = BASE_URL + CHAPTERS
 EPISODE_URL = BASE_URL + EPISODES
+EPISODE_BULK_URL = EPISODE_URL + '?' + BULK_APPEND
 PLAYLIST_URL = BASE_URL + PLAYLISTS
 SEARCH_URL = BASE_URL + 'search'
 SHOW_URL = BASE_URL + SHOWS
 TRACK_URL = BASE_URL + TRACKS
-TRACK_BULK_URL = TRACK_URL + '?' + BULK_APPEND
+TRACK_BULK_URL = TRACK_URL + '?' + MARKET_APPEND + '&' + BULK_APPEND
 TRACK_STATS_URL = BASE_URL + 'audio-features/'
 USER_URL = BASE_URL + 'me/'
 USER_FOLLOWED_ARTISTS_URL = USER_URL + 'following?type=' + ARTIST
 USER_PLAYLISTS_URL = USER_URL + PLAYLISTS
-USER_SAVED_TRACKS_URL = USER_URL + TRACKS
+USER_SAVED_TRACKS_URL = USER_URL + TRACKS + '?' + MARKET_APPEND
 LYRICS_URL = 'https://spclient.wg.sp' + 'otify.com/color-lyrics/v2/track/'
 PARTNER_URL = 'https://api-partner.sp' + 'otify.com/pathfinder/v1/query?operationName=getEpisode&variables={"uri":"sp' + 'otify:episode:'
+# only what parse_track_metadata, register_parent_albums and playlist downloads read, market drops available_markets
+PLAYLIST_TRACK_FIELDS = 'fields=next,items(added_at,track(id,linked_from(id),name,type,is_playable,duration_ms,track_number,disc_number,' +\
+                        'artists(id,name),album(id,name,album_type,release_date,total_tracks,images,artists(id,name))))'
+PLAYLIST_TRACKS_APPEND = PLAYLIST_TRACK_FIELDS + '&' + MARKET_APPEND
 PERSISTED_QUERY = '{"persistedQuery":{"version":1,"sha256Hash":"224ba0fd89fcfdfb'+'3a15fa2d82a6112d'+'3f4e2ac88fba5c67'+'13de04d1b72cf482"}}'
 
 # API Scopes
@@ -173,6 +179,7 @@ ROOT_PATH = 'ROOT_PATH'
 ROOT_PODCAST_PATH = 'ROOT_PODCAST_PATH'
 SKIP_EXISTING = 'SKIP_EXISTING'
 SKIP_PREVIOUSLY_DOWNLOADED = 'SKIP_PREVIOUSLY_DOWNLOADED'
+INCREMENTAL_LIKED_SONGS = 'INCREMENTAL_LIKED_SONGS'
 DOWNLOAD_FORMAT = 'DOWNLOAD_FORMAT'
 BULK_WAIT_TIME = 'BULK_WAIT_TIME'
 CHUNK_SIZE = 'CHUNK_SIZE'
@@ -186,6 +193,7 @@ SAVE_CREDENTIALS = 'SAVE_CREDENTIALS'
 CREDENTIALS_LOCATION = 'CREDENTIALS_LOCATION'
 OUTPUT = 'OUTPUT'
 PRINT_SPLASH = 'PRINT_SPLASH'
+HEADLESS = 'HEADLESS'
 PRINT_SKIPS = 'PRINT_SKIPS'
 PRINT_DOWNLOAD_PROGRESS = 'PRINT_DOWNLOAD_PROGRESS'
 PRINT_ERRORS = 'PRINT_ERRORS'
@@ -211,6 +219,12 @@ OUTPUT_ALBUM = 'OUTPUT_ALBUM'
 DISABLE_DIRECTORY_ARCHIVES = 'DISABLE_DIRECTORY_ARCHIVES'
 LYRICS_LOCATION = 'LYRICS_LOCATION'
 FFMPEG_LOG_LEVEL = 'FFMPEG_LOG_LEVEL'
+PRINT_PERF_REPORT = 'PRINT_PERF_REPORT'
+PERF_REPORT_FILE = 'PERF_REPORT_FILE'
+METRICS_PORT = 'METRICS_PORT'
+METRICS_ADDRESS = 'METRICS_ADDRESS'
+METRICS_TEXTFILE = 'METRICS_TEXTFILE'
+EVENT_LOG = 'EVENT_LOG'
 PRINT_URL_PROGRESS = 'PRINT_URL_PROGRESS'
 PRINT_ALBUM_PROGRESS = 'PRINT_ALBUM_PROGRESS'
 PRINT_ARTIST_PROGRESS = 'PRINT_ARTIST_PROGRESS'
@@ -226,6 +240,8 @@ DOWNLOAD_PARENT_ALBUM = 'DOWNLOAD_PARENT_ALBUM'
 DISABLE_SONG_ARCHIVE = 'DISABLE_SONG_ARCHIVE'
 REDIRECT_ADDRESS = 'REDIRECT_ADDRESS'
 LISTEN_ADDRESS = 'LISTEN_ADDRESS'
+SERVE_PORT = 'SERVE_PORT'
+SERVE_ADDRESS = 'SERVE_ADDRESS'
 NO_COMPILATION_ALBUMS = 'NO_COMPILATION_ALBUMS'
 REGEX_ENABLED = 'REGEX_ENABLED'
 REGEX_TRACK_SKIP = 'REGEX_TRACK_SKIP'
@@ -233,3 +249,13 @@ REGEX_EPISODE_SKIP = 'REGEX_EPISODE_SKIP'
 REGEX_ALBUM_SKIP = 'REGEX_ALBUM_SKIP'
 LYRICS_MD_HEADER = 'LYRICS_MD_HEADER'
 STRICT_LIBRARY_VERIFY = 'STRICT_LIBRARY_VERIFY'
+STREAM_TRANSCODE = 'STREAM_TRANSCODE'
+TRANSCODE_WORKERS = 'TRANSCODE_WORKERS'
+CACHE_LOCATION = 'CACHE_LOCATION'
+PODCAST_DOWNLOAD_WORKERS = 'PODCAST_DOWNLOAD_WORKERS'
+DIRECT_DOWNLOAD_CONNECTIONS = 'DIRECT_DOWNLOAD_CONNECTIONS'
+SYNC_INTERVAL = 'SYNC_INTERVAL'
+ARTWORK_CACHE = 'ARTWORK_CACHE'
+LYRICS_CACHE_TTL = 'LYRICS_CACHE_TTL'
+ALBUM_ART_MAX_SIZE = 'ALBUM_ART_MAX_SIZE'
+ALBUM_ART_QUALITY = 'ALBUM_ART_QUALITY'
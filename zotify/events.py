@@ -0,0 +1,44 @@
+import json
+import sys
+import time
+from threading import Lock
+from typing import TextIO
+
+from zotify.config import Zotify
+from zotify.perf import Perf
+
+
+class EventLog:
+    """
+    Structured JSON lines event stream
+    
+    Every download outcome is written as one JSON object per line, so orchestrators can follow progress
+    and compute throughput without parsing terminal output. The target is opened once and lines are
+    written whole under a lock, keeping the cost to a json.dumps per event.
+    """
+    TARGET: TextIO | None = None
+    OPENED = False
+    LOCK = Lock()
+    
+    @classmethod
+    def _target(cls) -> TextIO | None:
+        if not cls.OPENED:
+            event_log = Zotify.CONFIG.get_event_log()
+            if event_log == '-':
+                cls.TARGET = sys.stdout
+            elif event_log is not None:
+                cls.TARGET = open(event_log, 'a', encoding='utf-8', buffering=1)
+            cls.OPENED = True
+        return cls.TARGET
+    
+    @classmethod
+    def emit(cls, event: str, **fields) -> None:
+        """ Writes an event, fields left as None are omitted """
+        Perf.count(f'events:{event}') # counted even when no event log is configured
+        with cls.LOCK:
+            target = cls._target()
+            if target is None:
+                return
+            record = {'ts': round(time.time(), 3), 'event': event}
+            record.update((key, value) for key, value in fields.items() if value is not None)
+            target.write(json.dumps(record, default=str) + '\n')
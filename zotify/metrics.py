@@ -0,0 +1,132 @@
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path, PurePath
+from threading import Event, Thread
+
+from zotify.config import Zotify
+from zotify.perf import Perf
+from zotify.termoutput import Printer, PrintChannel
+from zotify.transcode import TranscodePool
+
+
+class Metrics:
+    """
+    Prometheus/OpenMetrics exporter
+    
+    Renders the run's Perf counters and stage timings in the Prometheus text format, either served over HTTP
+    for scraping or written periodically to a file for node_exporter's textfile collector.
+    """
+    TEXTFILE_INTERVAL = 15
+    SERVER: ThreadingHTTPServer | None = None
+    STOP = Event()
+    STARTED = time.time()
+    
+    @staticmethod
+    def _escape(value: str) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    
+    @classmethod
+    def render(cls) -> str:
+        with Perf.LOCK:
+            histograms = {stage: {'buckets': list(h['buckets']), 'count': h['count'], 'sum': h['sum']}
+                          for stage, h in Perf.HISTOGRAMS.items()}
+            counters = dict(Perf.COUNTERS)
+        
+        labelled: dict[str, dict[str, int]] = {}
+        for counter, value in counters.items():
+            name, _, label = counter.partition(':')
+            if label:
+                labelled.setdefault(name, {})[label] = value
+        
+        lines = []
+        def metric(name: str, kind: str, help: str, series: list[tuple[str, float]]):
+            lines.append(f'# HELP zotify_{name} {help}')
+            lines.append(f'# TYPE zotify_{name} {kind}')
+            for labels, value in series:
+                lines.append(f'zotify_{name}{labels} {value}')
+        
+        metric('start_time_seconds', 'gauge', 'Unix time the run started',
+               [('', cls.STARTED)])
+        metric('events_total', 'counter', 'Download outcomes by event, e.g. downloaded, skipped, error',
+               [(f'{{event="{cls._escape(e)}"}}', v) for e, v in sorted(labelled.get('events', {}).items())])
+        metric('api_calls_total', 'counter', 'Web API requests made',
+               [('', Zotify.TOTAL_API_CALLS)])
+        metric('api_errors_total', 'counter', 'Web API error responses by status',
+               [(f'{{status="{cls._escape(s)}"}}', v) for s, v in sorted(labelled.get('api_errors', {}).items())])
+        metric('api_retry_waits_total', 'counter', 'Back-off waits after API errors, including rate limiting',
+               [('', histograms.get('api_retry_wait', {}).get('count', 0))])
+        metric('stream_bytes_total', 'counter', 'Audio bytes downloaded',
+               [('', counters.get('stream_bytes', 0))])
+        metric('transcode_queue_depth', 'gauge', 'Conversions queued or running in the background',
+               [('', TranscodePool.queue_depth())])
+        
+        lines.append('# HELP zotify_stage_duration_seconds Time spent per pipeline stage')
+        lines.append('# TYPE zotify_stage_duration_seconds histogram')
+        for stage, histogram in sorted(histograms.items()):
+            stage = cls._escape(stage)
+            cumulative = 0
+            for bound, count in zip(Perf.BUCKETS, histogram['buckets']):
+                cumulative += count
+                lines.append(f'zotify_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'zotify_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}')
+            lines.append(f'zotify_stage_duration_seconds_sum{{stage="{stage}"}} {histogram["sum"]}')
+            lines.append(f'zotify_stage_duration_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+        
+        return '\n'.join(lines) + '\n'
+    
+    @classmethod
+    def write_textfile(cls, path: PurePath) -> None:
+        # write then rename, the collector may read the file at any moment
+        temp_path = Path(path).with_suffix('.part')
+        temp_path.write_text(cls.render(), encoding='utf-8')
+        temp_path.replace(path)
+    
+    @classmethod
+    def _textfile_loop(cls, path: PurePath) -> None:
+        while not cls.STOP.wait(cls.TEXTFILE_INTERVAL):
+            cls.write_textfile(path)
+    
+    @classmethod
+    def start(cls) -> None:
+        """ Starts whichever exporters are configured """
+        port = Zotify.CONFIG.get_metrics_port()
+        if port:
+            cls.SERVER = ThreadingHTTPServer((Zotify.CONFIG.get_metrics_address(), port), MetricsHandler)
+            cls.SERVER.daemon_threads = True
+            Thread(target=cls.SERVER.serve_forever, daemon=True, name="zotify-metrics").start()
+            Printer.debug(f"Serving Metrics On http://{Zotify.CONFIG.get_metrics_address()}:{port}/metrics")
+        
+        textfile = Zotify.CONFIG.get_metrics_textfile()
+        if textfile:
+            cls.write_textfile(textfile)
+            Thread(target=cls._textfile_loop, args=(textfile,), daemon=True, name="zotify-metrics-textfile").start()
+    
+    @classmethod
+    def stop(cls) -> None:
+        """ Writes the final textfile and stops the HTTP endpoint """
+        cls.STOP.set()
+        textfile = Zotify.CONFIG.get_metrics_textfile()
+        if textfile:
+            try:
+                cls.write_textfile(textfile)
+            except OSError as e:
+                Printer.hashtaged(PrintChannel.WARNING, f'FAILED TO WRITE METRICS TEXTFILE\n{e}')
+        if cls.SERVER is not None:
+            cls.SERVER.shutdown()
+            cls.SERVER = None
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in {'/metrics', '/'}:
+            self.send_error(404)
+            return
+        body = Metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
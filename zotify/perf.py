@@ -0,0 +1,106 @@
+import json
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+
+
+class Perf:
+    """
+    Per-stage timers and counters for the run performance report
+    
+    Every timed stage keeps its individual samples so percentiles can be reported at the end of a run.
+    Stages listed in SLEEP_STAGES are deliberate waits rather than work. HISTOGRAMS keeps running bucket
+    counts per stage alongside, so exporters never have to walk the samples.
+    """
+    SAMPLES: dict[str, list[float]] = defaultdict(list)
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    HISTOGRAMS: dict[str, dict] = defaultdict(lambda: {'buckets': [0] * len(Perf.BUCKETS), 'count': 0, 'sum': 0.0})
+    COUNTERS: dict[str, int] = defaultdict(int)
+    SLEEP_STAGES = {'wait', 'realtime_wait', 'api_retry_wait', 'loader_wait'}
+    START = time.perf_counter()
+    LOCK = Lock()
+    
+    @classmethod
+    @contextmanager
+    def timer(cls, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            cls.record(stage, time.perf_counter() - start)
+    
+    @classmethod
+    def record(cls, stage: str, seconds: float) -> None:
+        with cls.LOCK:
+            cls.SAMPLES[stage].append(seconds)
+            histogram = cls.HISTOGRAMS[stage]
+            # per bucket counts, slower samples than the last bound only land in the +Inf count
+            bucket = bisect_left(cls.BUCKETS, seconds)
+            if bucket < len(cls.BUCKETS):
+                histogram['buckets'][bucket] += 1
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+    
+    @classmethod
+    def count(cls, counter: str, n: int = 1) -> None:
+        """ Increments `counter`, where a `name:label` counter is one labelled series of `name` """
+        with cls.LOCK:
+            cls.COUNTERS[counter] += n
+    
+    @classmethod
+    def sleep(cls, seconds: float, stage: str = 'wait') -> None:
+        with cls.timer(stage):
+            time.sleep(seconds)
+    
+    @staticmethod
+    def _percentile(samples: list[float], p: float) -> float:
+        # nearest-rank, samples must already be sorted
+        return samples[max(int(round(p / 100 * len(samples))) - 1, 0)]
+    
+    @classmethod
+    def summary(cls) -> dict:
+        with cls.LOCK:
+            samples = {stage: sorted(values) for stage, values in cls.SAMPLES.items() if values}
+            counters = dict(cls.COUNTERS)
+        
+        wall = time.perf_counter() - cls.START
+        stages = {stage: {'count': len(values),
+                          'total': sum(values),
+                          'p50': cls._percentile(values, 50),
+                          'p95': cls._percentile(values, 95),
+                          'max': values[-1]}
+                  for stage, values in samples.items()}
+        sleeping = sum(stage['total'] for name, stage in stages.items() if name in cls.SLEEP_STAGES)
+        streaming = stages.get('stream', {}).get('total', 0)
+        
+        return {'wall': wall,
+                'sleeping': sleeping,
+                'working': max(wall - sleeping, 0),
+                'stream_bytes_per_sec': counters.get('stream_bytes', 0) / streaming if streaming else 0,
+                'stages': stages,
+                'counters': counters}
+    
+    @classmethod
+    def print_report(cls) -> None:
+        from zotify.termoutput import Printer
+        summary = cls.summary()
+        rows = [[stage, s['count'], f"{s['total']:.2f}s", f"{s['p50'] * 1000:.1f}ms", f"{s['p95'] * 1000:.1f}ms", f"{s['max'] * 1000:.1f}ms"]
+                for stage, s in sorted(summary['stages'].items(), key=lambda item: -item[1]['total'])]
+        Printer.table('RUN PERFORMANCE REPORT', ('Stage', 'Count', 'Total', 'p50', 'p95', 'Max'), rows)
+        
+        wall = summary['wall'] or 1
+        Printer.table('RUN TOTALS', ('Metric', 'Value'), [
+            ['Wall time', f"{summary['wall']:.2f}s"],
+            ['Working', f"{summary['working']:.2f}s ({summary['working'] / wall:.0%})"],
+            ['Sleeping', f"{summary['sleeping']:.2f}s ({summary['sleeping'] / wall:.0%})"],
+            ['Stream throughput', f"{summary['stream_bytes_per_sec'] / 2**20:.2f} MiB/s"],
+            *[[counter, value] for counter, value in sorted(summary['counters'].items())],
+        ])
+    
+    @classmethod
+    def export(cls, path: str | Path) -> None:
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(cls.summary(), file, indent=4)
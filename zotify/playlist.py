@@ -1,17 +1,22 @@
 from pathlib import PurePath, Path
 
+from zotify.album import register_parent_albums
 from zotify.config import Zotify
-from zotify.const import USER_PLAYLISTS_URL, PLAYLIST_URL, ITEMS, ID, TRACK, NAME, TYPE, TRACKS
+from zotify.const import USER_PLAYLISTS_URL, PLAYLIST_URL, ITEMS, ID, TRACK, NAME, TYPE, TRACKS, SNAPSHOT_ID, \
+    PLAYLIST_TRACKS_APPEND
+from zotify.perf import Perf
 from zotify.podcast import download_episode
 from zotify.termoutput import Printer, PrintChannel
 from zotify.track import parse_track_metadata, download_track
-from zotify.utils import split_sanitize_intrange, strptime_utc, fill_output_template
+from zotify.transcode import TranscodePool
+from zotify.utils import split_sanitize_intrange, strptime_utc, fill_output_template, regex_input_for_urls, \
+    remove_from_m3u8, get_playlist_sync_state, save_playlist_sync_state
 
 
 def get_playlist_songs(playlist_id: str) -> tuple[list[str], list[dict]]:
     """ returns list of songs in a playlist """
     
-    playlist_tracks = Zotify.invoke_url_nextable(f'{PLAYLIST_URL}/{playlist_id}/{TRACKS}', ITEMS, 100)
+    playlist_tracks = Zotify.invoke_url_nextable(f'{PLAYLIST_URL}/{playlist_id}/{TRACKS}?{PLAYLIST_TRACKS_APPEND}', ITEMS, 100)
     
     playlist_tracks.sort(key=lambda s: strptime_utc(s['added_at']))
     
@@ -36,9 +41,39 @@ def get_playlist_info(playlist_id) -> tuple[str, str]:
     return resp['name'].strip(), resp['owner']['display_name'].strip()
 
 
-def download_playlist(playlist: dict, pbar_stack: list | None = None):
-    """Downloads all the songs from a playlist"""
-    playlist_num, playlist_tracks = get_playlist_songs(playlist[ID])
+def get_playlist_m3u8_path(playlist: dict, playlist_tracks: list[dict | None]) -> Path:
+    """ Predicts where a playlist's .m3u8 file belongs, next to its tracks unless M3U8_LOCATION is set """
+    m3u_dir = Zotify.CONFIG.get_m3u8_location()
+    if m3u_dir is None:
+        m3u_dir = Zotify.CONFIG.get_root_path()
+        output_template = Zotify.CONFIG.get_output("extplaylist")
+        extra_keys = {'playlist': playlist[NAME], 'playlist_id': playlist[ID]}
+        try:
+            if len(playlist_tracks) > 0:
+                extra_keys.update({'playlist_num': "00"})
+                first_track_path, _ = fill_output_template(output_template, parse_track_metadata(playlist_tracks[0]), extra_keys)
+                m3u_dir /= PurePath(first_track_path).parent
+            if len(playlist_tracks) > 1:
+                extra_keys.update({'playlist_num': "01"})
+                second_track_path, _ = fill_output_template(output_template, parse_track_metadata(playlist_tracks[1]), extra_keys)
+                if PurePath(first_track_path).parent != PurePath(second_track_path).parent:
+                    raise ValueError(f'No shared parent directory between `{first_track_path}` and `{second_track_path}`')
+        except Exception as e:
+            Printer.hashtaged(PrintChannel.ERROR, f'FAILED TO PREDICT M3U8 DIRECTORY FOR "{playlist[NAME]}"\n' +\
+                                                   'Ensure OUTPUT_PLAYLIST_EXT only varies per song in the final path section')
+            Printer.traceback(e)
+            m3u_dir = m3u_dir.parent # fallback to root path
+    
+    return Path(m3u_dir / (playlist[NAME] + ".m3u8"))
+
+
+def download_playlist(playlist: dict, pbar_stack: list | None = None,
+                      playlist_songs: tuple[list[str], list[dict]] | None = None, track_ids: set[str] | None = None) -> tuple[set[str], dict[str, str]]:
+    """Downloads all the songs from a playlist, or only those in `track_ids` while appending to its existing .m3u8,
+    returning the ids of songs that failed and the path each song was saved under"""
+    playlist_num, playlist_tracks = playlist_songs if playlist_songs else get_playlist_songs(playlist[ID])
+    if Zotify.CONFIG.get_download_parent_album():
+        register_parent_albums(playlist_tracks)
     
     pos, pbar_stack = Printer.pbar_position_handler(3, pbar_stack)
     pbar = Printer.pbar(playlist_tracks, unit='song', pos=pos,
@@ -56,38 +91,22 @@ def download_playlist(playlist: dict, pbar_stack: list | None = None):
         playlist_tracks.reverse()
     else:
         # verify playlist m3u8 matches current playlist
-        m3u_dir = Zotify.CONFIG.get_m3u8_location()
-        if m3u_dir is None:
-            m3u_dir = Zotify.CONFIG.get_root_path()
-            try:
-                if len(playlist_tracks) > 0:
-                    output_template = Zotify.CONFIG.get_output(mode)
-                    extra_keys.update({'playlist_num': "00"})
-                    first_track_path, _ = fill_output_template(output_template, parse_track_metadata(playlist_tracks[0]), extra_keys)
-                    m3u_dir /= PurePath(first_track_path).parent
-                if len(playlist_tracks) > 1:
-                    extra_keys.update({'playlist_num': "01"})
-                    second_track_path, _ = fill_output_template(output_template, parse_track_metadata(playlist_tracks[1]), extra_keys)
-                    if PurePath(first_track_path).parent != PurePath(second_track_path).parent:
-                        raise ValueError(f'No shared parent directory between `{first_track_path}` and `{second_track_path}`')
-            except Exception as e:
-                Printer.hashtaged(PrintChannel.ERROR, f'FAILED TO PREDICT M3U8 DIRECTORY FOR "{playlist[NAME]}"\n' +\
-                                                       'Ensure OUTPUT_PLAYLIST_EXT only varies per song in the final path section')
-                Printer.traceback(e)
-                m3u_dir = m3u_dir.parent # fallback to root path
-        
-        m3u8_path = Path(m3u_dir / (playlist[NAME] + ".m3u8"))
+        m3u8_path = get_playlist_m3u8_path(playlist, playlist_tracks)
         old_m3u8_path = m3u8_path.with_suffix('.old.m3u8')
-        if m3u8_path.exists():
+        if m3u8_path.exists() and track_ids is None:
             # handle unfinished / interupted / old m3u8 files
             if old_m3u8_path.exists():
                 old_m3u8_path.unlink()
             m3u8_path.rename(old_m3u8_path)
         extra_keys.update({'m3u8_path': m3u8_path})
     
+    failed = set()
+    track_paths = {}
     for i, song in enumerate(pbar):
         if song is None:
             continue
+        elif track_ids is not None and song[ID] not in track_ids:
+            continue
         elif song[TYPE] == "episode": # Playlist item is a podcast episode
             pbar.unit = 'episode'
             download_episode(song[ID])
@@ -96,12 +115,18 @@ def download_playlist(playlist: dict, pbar_stack: list | None = None):
             extra_keys.update({'playlist_num': playlist_num[i],
                                'playlist_track': song[NAME],
                                'playlist_track_id': song[ID]})
-            download_track(mode, song[ID], extra_keys, pbar_stack)
+            extra_keys.pop('track_path', None)
+            if not download_track(mode, song[ID], extra_keys, pbar_stack):
+                failed.add(song[ID])
+            if 'track_path' in extra_keys:
+                track_paths[song[ID]] = str(extra_keys['track_path'])
         pbar.set_description(song[NAME])
         Printer.refresh_all_pbars(pbar_stack)
     
     if Zotify.CONFIG.get_export_m3u8() and old_m3u8_path.exists():
         old_m3u8_path.unlink()
+    
+    return failed, track_paths
 
 
 def download_from_user_playlist():
@@ -123,3 +148,83 @@ def download_from_user_playlist():
         download_playlist(playlist, pbar_stack)
         pbar.set_description(playlist[NAME].strip())
         Printer.refresh_all_pbars(pbar_stack)
+
+
+def sync_playlist(playlist: dict, state: dict[str, dict], pbar_stack: list | None = None) -> None:
+    """ Brings a playlist up to date with its last sync, downloading added songs and pruning removed ones from its .m3u8 """
+    previous = state.get(playlist[ID])
+    if previous is not None and previous[SNAPSHOT_ID] == playlist[SNAPSHOT_ID]:
+        Printer.hashtaged(PrintChannel.SKIPPING, f'"{playlist[NAME]}" (PLAYLIST UNCHANGED SINCE LAST SYNC)')
+        return
+    
+    playlist_num, playlist_tracks = get_playlist_songs(playlist[ID])
+    current = {song[ID]: song for song in playlist_tracks if song is not None}
+    
+    failed, track_paths = set(), {}
+    if previous is None:
+        failed, track_paths = download_playlist(playlist, pbar_stack, (playlist_num, playlist_tracks))
+    else:
+        added = current.keys() - previous[TRACKS].keys()
+        removed = previous[TRACKS].keys() - current.keys()
+        Printer.hashtaged(PrintChannel.PROGRESS_INFO, f'"{playlist[NAME]}" CHANGED SINCE LAST SYNC\n' +\
+                                                      f'{len(added)} SONGS ADDED - {len(removed)} SONGS REMOVED')
+        if removed and Zotify.CONFIG.get_export_m3u8():
+            removed_paths = {previous[TRACKS][track_id] for track_id in removed if previous[TRACKS][track_id]}
+            remove_from_m3u8(get_playlist_m3u8_path(playlist, playlist_tracks), removed_paths)
+        if added:
+            failed, track_paths = download_playlist(playlist, pbar_stack, (playlist_num, playlist_tracks), added)
+    
+    # the file each song was saved under, so removed songs can be found in the playlist file later.
+    # songs kept from earlier syncs keep their path, their playlist_num may have shifted since
+    tracks: dict[str, str | None] = {track_id: previous[TRACKS][track_id] if previous and track_id in previous[TRACKS]
+                                     else track_paths.get(track_id) for track_id in current}
+    
+    # conversions that fail in the background count as failed too
+    TranscodePool.join()
+    failed |= {track_id for track_id in tracks if TranscodePool.failed(track_id)}
+    if failed:
+        # left out of the state and without a snapshot, so the next sync sees them as added and retries them
+        Printer.hashtaged(PrintChannel.WARNING, f'"{playlist[NAME]}" SYNCED WITH {len(failed)} FAILED SONGS, RETRYING NEXT SYNC')
+        tracks = {track_id: path for track_id, path in tracks.items() if track_id not in failed}
+    
+    state[playlist[ID]] = {NAME: playlist[NAME], SNAPSHOT_ID: None if failed else playlist[SNAPSHOT_ID], TRACKS: tracks}
+    save_playlist_sync_state(state)
+
+
+def sync_playlists(urls: list[str] | None = None) -> None:
+    """ Syncs the playlists given by url, or every playlist saved by the account, skipping those whose snapshot is unchanged """
+    if urls:
+        playlists = []
+        for url in urls:
+            playlist_id = regex_input_for_urls(url, non_global=True)[2]
+            if playlist_id is None:
+                Printer.hashtaged(PrintChannel.WARNING, f'No valid playlist id found in {url}, skipping...')
+                continue
+            # only the fields needed to tell whether anything changed
+            (raw, resp) = Zotify.invoke_url(f'{PLAYLIST_URL}/{playlist_id}?fields={NAME},{SNAPSHOT_ID}')
+            playlists.append({ID: playlist_id, NAME: resp[NAME].strip(), SNAPSHOT_ID: resp[SNAPSHOT_ID]})
+    else:
+        # saved playlists already carry their snapshot_id
+        playlists = [playlist for playlist in Zotify.invoke_url_nextable(USER_PLAYLISTS_URL, ITEMS) if playlist]
+    
+    state = get_playlist_sync_state()
+    
+    pos = 5
+    pbar = Printer.pbar(playlists, unit='playlist', pos=pos, 
+                        disable=not Zotify.CONFIG.get_show_url_pbar())
+    pbar_stack = [pbar]
+    
+    for playlist in pbar:
+        playlist[NAME] = playlist[NAME].strip()
+        sync_playlist(playlist, state, pbar_stack)
+        pbar.set_description(playlist[NAME])
+        Printer.refresh_all_pbars(pbar_stack)
+
+
+def watch_playlists(urls: list[str] | None = None) -> None:
+    """ Syncs playlists, repeating every SYNC_INTERVAL minutes if it is set """
+    sync_playlists(urls)
+    while Zotify.CONFIG.get_sync_interval():
+        Printer.hashtaged(PrintChannel.PROGRESS_INFO, f'NEXT SYNC IN {Zotify.CONFIG.get_sync_interval()} MINUTES')
+        Perf.sleep(Zotify.CONFIG.get_sync_interval() * 60)
+        sync_playlists(urls)
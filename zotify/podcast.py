@@ -1,13 +1,25 @@
 import time
 import ffmpy
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import PurePath, Path
+from threading import Lock
 from librespot.metadata import EpisodeId
 
 from zotify.config import Zotify
-from zotify.const import EPISODE_URL, SHOW_URL, PARTNER_URL, PERSISTED_QUERY, ERROR, ID, ITEMS, NAME, SHOW, DURATION_MS, EXT_MAP
+from zotify.const import EPISODE_URL, EPISODE_BULK_URL, EPISODES, SHOW_URL, PARTNER_URL, PERSISTED_QUERY, ERROR, ID, ITEMS, NAME, SHOW, DURATION_MS, EXT_MAP
+from zotify.events import EventLog
+from zotify.perf import Perf
 from zotify.termoutput import PrintChannel, Printer, Loader
-from zotify.utils import create_download_directory, fix_filename, fmt_duration, wait_between_downloads
+from zotify.utils import create_download_directory, fix_filename, fmt_duration, wait_between_downloads, sniff_audio_file, \
+    get_archived_episode_ids, add_to_podcast_archive
+
+
+def parse_episode_info(resp: dict | None) -> tuple[str | None, str | None, str | None]:
+    if not resp or ERROR in resp:
+        return None, None, None
+    duration_ms = resp[DURATION_MS]
+    return fix_filename(resp[SHOW][NAME]), duration_ms, fix_filename(resp[NAME])
 
 
 def get_episode_info(episode_id: str) -> tuple[str | None, str | None, str | None]:
@@ -15,10 +27,15 @@ def get_episode_info(episode_id: str) -> tuple[str | None, str | None, str | Non
         (raw, resp) = Zotify.invoke_url(f'{EPISODE_URL}/{episode_id}')
     if not resp:
         Printer.hashtaged(PrintChannel.ERROR, 'INVALID EPISODE ID')
-    if ERROR in resp:
-        return None, None, None
-    duration_ms = resp[DURATION_MS]
-    return fix_filename(resp[SHOW][NAME]), duration_ms, fix_filename(resp[NAME])
+    return parse_episode_info(resp)
+
+
+def get_episodes_info(episode_ids: list[str]) -> list[tuple[str | None, str | None, str | None]]:
+    """ Returns episode info for up to 50 episodes per request """
+    with Loader(PrintChannel.PROGRESS_INFO, "Fetching episode information..."):
+        episodes = Zotify.invoke_url_bulk(EPISODE_BULK_URL, episode_ids, EPISODES)
+    # unavailable episodes are returned as null
+    return [parse_episode_info(episode) for episode in episodes]
 
 
 def get_show_episode_ids(show_id: str) -> list:
@@ -27,53 +44,150 @@ def get_show_episode_ids(show_id: str) -> list:
     return [episode[ID] for episode in episodes]
 
 
-def download_podcast_directly(url, filename):
+DIRECT_SEGMENT_MIN_SIZE = 1024 * 1024
+DIRECT_TIMEOUT = 30
+STREAM_LOCK = Lock()
+
+
+class RangeNotSupportedError(Exception):
+    pass
+
+
+def download_podcast_directly(url, filename, show_pbar: bool = True):
+    import requests
+    
+    path = Path(filename).expanduser().resolve()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    
+    connections = Zotify.CONFIG.get_direct_download_connections()
+    try:
+        head = requests.head(url, allow_redirects=True, timeout=DIRECT_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        Printer.debug(f"HEAD Request Failed ({e}) - Falling Back To A Single Connection")
+        return download_podcast_single(url, path, show_pbar)
+    file_size = int(head.headers.get('Content-Length', 0)) if head.ok else 0
+    ranged = head.headers.get('Accept-Ranges', '').lower() == 'bytes'
+    
+    if connections > 1 and ranged and file_size >= 2 * DIRECT_SEGMENT_MIN_SIZE:
+        try:
+            return download_podcast_segmented(head.url, path, file_size, connections, show_pbar)
+        except RangeNotSupportedError:
+            Printer.debug("Server Ignored Range Requests - Falling Back To A Single Connection")
+    
+    return download_podcast_single(url, path, show_pbar)
+
+
+def download_podcast_single(url, path: Path, show_pbar: bool = True):
     import functools
     import shutil
     import requests
     from tqdm.auto import tqdm
     
-    r = requests.get(url, stream=True, allow_redirects=True)
+    r = requests.get(url, stream=True, allow_redirects=True, timeout=DIRECT_TIMEOUT)
     if r.status_code != 200:
         r.raise_for_status()  # Will only raise for 4xx codes, so...
         raise RuntimeError(
             f"Request to {url} returned status code {r.status_code}")
     file_size = int(r.headers.get('Content-Length', 0))
     
-    path = Path(filename).expanduser().resolve()
-    path.parent.mkdir(parents=True, exist_ok=True)
-    
     desc = "(Unknown total file size)" if file_size == 0 else ""
     r.raw.read = functools.partial(
         r.raw.read, decode_content=True)  # Decompress if needed
-    with tqdm.wrapattr(r.raw, "read", total=file_size, desc=desc) as r_raw:
+    with tqdm.wrapattr(r.raw, "read", total=file_size, desc=desc,
+                       disable=not (show_pbar and Zotify.CONFIG.get_show_download_pbar()) or Zotify.CONFIG.get_headless()) as r_raw:
         with path.open("wb") as f:
             shutil.copyfileobj(r_raw, f)
     
+    if file_size and path.stat().st_size != file_size:
+        raise RuntimeError(f"Downloaded {path.stat().st_size} of {file_size} bytes from {url}")
+    
+    return path
+
+
+def download_podcast_segmented(url, path: Path, file_size: int, connections: int, show_pbar: bool = True):
+    """ Downloads `url` over parallel Range requests, writing each segment in place into a preallocated file """
+    import requests
+    
+    segment_size = max(-(-file_size // connections), DIRECT_SEGMENT_MIN_SIZE)
+    segments = [(start, min(start + segment_size, file_size) - 1) for start in range(0, file_size, segment_size)]
+    
+    with path.open("wb") as f:
+        f.truncate(file_size)
+    
+    lock = Lock()
+    with Printer.pbar(total=file_size, unit='B', unit_scale=True, unit_divisor=1024,
+                      disable=not (show_pbar and Zotify.CONFIG.get_show_download_pbar())) as pbar:
+        
+        def fetch_segment(start: int, end: int) -> int:
+            received = 0
+            attempts = 0
+            with path.open("r+b") as f:
+                while start + received <= end:
+                    try:
+                        # resume from the last byte written rather than restarting the segment
+                        r = requests.get(url, stream=True, timeout=DIRECT_TIMEOUT,
+                                         headers={'Range': f'bytes={start + received}-{end}'})
+                        if r.status_code == 200:
+                            raise RangeNotSupportedError()
+                        r.raise_for_status()
+                        f.seek(start + received)
+                        for chunk in r.iter_content(Zotify.CONFIG.get_chunk_size()):
+                            f.write(chunk)
+                            received += len(chunk)
+                            with lock:
+                                pbar.update(len(chunk))
+                        if start + received <= end:
+                            raise requests.exceptions.ChunkedEncodingError(
+                                f"Segment {start}-{end} ended after {received} bytes")
+                    except requests.exceptions.RequestException:
+                        attempts += 1
+                        if attempts > Zotify.CONFIG.get_retry_attempts():
+                            raise
+                        time.sleep(1)
+            return received
+        
+        with ThreadPoolExecutor(max_workers=connections, thread_name_prefix="zotify-segment") as executor:
+            received = sum(executor.map(lambda segment: fetch_segment(*segment), segments))
+    
+    if received != file_size or path.stat().st_size != file_size:
+        raise RuntimeError(f"Downloaded {received} of {file_size} bytes from {url}")
+    
     return path
 
 
 def download_show(show_id, pbar_stack: list | None = None):
     episode_ids = get_show_episode_ids(show_id)
+    episode_infos = get_episodes_info(episode_ids)
+    workers = Zotify.CONFIG.get_podcast_download_workers()
     
     pos, pbar_stack = Printer.pbar_position_handler(3, pbar_stack)
-    pbar = Printer.pbar(episode_ids, unit='episode', pos=pos,
+    pbar = Printer.pbar(total=len(episode_ids), unit='episode', pos=pos,
                         disable=not Zotify.CONFIG.get_show_playlist_pbar())
     pbar_stack.append(pbar)
     
-    for episode in pbar:
-        download_episode(episode, pbar_stack)
-        pbar.set_description(get_episode_info(episode)[2])
-        Printer.refresh_all_pbars(pbar_stack)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="zotify-episode") as executor:
+        # byte-level progress bars would overlap when several episodes download at once
+        futures = {executor.submit(download_episode, episode_id, pbar_stack, episode_info, workers == 1): episode_info
+                   for episode_id, episode_info in zip(episode_ids, episode_infos)}
+        for future in as_completed(futures):
+            future.result()
+            pbar.update()
+            if futures[future][2]:
+                pbar.set_description(futures[future][2])
+            Printer.refresh_all_pbars(pbar_stack)
 
 
-def download_episode(episode_id, pbar_stack: list | None = None) -> None:
+def download_episode(episode_id, pbar_stack: list | None = None,
+                     episode_info: tuple[str | None, str | None, str | None] | None = None, show_pbar: bool = True) -> None:
     
-    podcast_name, duration_ms, episode_name = get_episode_info(episode_id)
+    if episode_info is None:
+        episode_info = get_episode_info(episode_id)
+    podcast_name, duration_ms, episode_name = episode_info
     
     if podcast_name is None or episode_name is None or duration_ms is None:
         Printer.hashtaged(PrintChannel.ERROR, 'SKIPPING EPISODE - FAILED TO QUERY METADATA\n' +\
                                              f'Episode_ID: {str(episode_id)}')
+        EventLog.emit('error', kind='episode', id=episode_id, stage='metadata')
         wait_between_downloads(); return
     
     if Zotify.CONFIG.get_regex_episode():
@@ -82,94 +196,129 @@ def download_episode(episode_id, pbar_stack: list | None = None) -> None:
             Printer.hashtaged(PrintChannel.SKIPPING, 'EPISODE MATCHES REGEX FILTER\n' +\
                                                     f'Episode_Name: {episode_name} - Episode_ID: {episode_id}\n'+\
                                                    (f'Regex Groups: {regex_match.groupdict()}' if regex_match.groups() else ""))
+            EventLog.emit('skipped', kind='episode', id=episode_id, reason='regex')
             wait_between_downloads(); return
     
+    filename = f"{podcast_name} - {episode_name}"
+    episode_path = PurePath(Zotify.CONFIG.get_root_podcast_path()) / podcast_name / f"{filename}.tmp"
+    
+    # archived episodes that are still on disk are skipped before any stream negotiation
+    if Zotify.CONFIG.get_skip_existing() and episode_id in get_archived_episode_ids() and \
+       any(Path(episode_path.parent).glob(episode_path.stem + ".*", case_sensitive=True)):
+        Printer.hashtaged(PrintChannel.SKIPPING, f'"{podcast_name} - {episode_name}" (EPISODE ALREADY EXISTS)')
+        EventLog.emit('skipped', kind='episode', id=episode_id, reason='archived')
+        wait_between_downloads(); return
+    
     with Loader(PrintChannel.PROGRESS_INFO, "Preparing download..."):
-        filename = f"{podcast_name} - {episode_name}"
-        episode_path = PurePath(Zotify.CONFIG.get_root_podcast_path()) / podcast_name / f"{filename}.tmp"
         create_download_directory(episode_path.parent)
         
         (raw, resp) = Zotify.invoke_url(PARTNER_URL + episode_id + '"}&extensions=' + PERSISTED_QUERY)
         direct_download_url = resp["data"]["episode"]["audio"]["items"][-1]["url"]
         
         if "anon-podcast.scdn.co" in direct_download_url or "audio_preview_url" not in resp:
-            episode_id = EpisodeId.from_base62(episode_id)
-            stream = Zotify.get_content_stream(episode_id, Zotify.DOWNLOAD_QUALITY)
-            
-            if stream is None:
-                Printer.hashtaged(PrintChannel.ERROR, 'SKIPPING EPISODE - FAILED TO GET CONTENT STREAM\n' +\
+            # concurrent workers only speed up direct CDN downloads, librespot streams share one session
+            with STREAM_LOCK:
+                stream = Zotify.get_content_stream(EpisodeId.from_base62(episode_id), Zotify.DOWNLOAD_QUALITY)
+                
+                if stream is None:
+                    Printer.hashtaged(PrintChannel.ERROR, 'SKIPPING EPISODE - FAILED TO GET CONTENT STREAM\n' +\
+                                                         f'Episode_ID: {str(episode_id)}')
+                    EventLog.emit('error', kind='episode', id=episode_id, stage='stream', error='NoContentStream')
+                    wait_between_downloads(); return
+                
+                episode_path_exists = False
+                total_size: int = stream.input_stream.size
+                for episode_file_match in Path(episode_path.parent).glob(episode_path.stem + ".*", case_sensitive=True):
+                    episode_path_exists = episode_file_match.stat().st_size == total_size
+                    if episode_path_exists: break
+                if episode_path_exists and Zotify.CONFIG.get_skip_existing():
+                    # downloaded before the podcast archive existed, archive it so the next run skips it early
+                    add_to_podcast_archive(episode_id, episode_file_match.name, podcast_name, episode_name)
+                    Printer.hashtaged(PrintChannel.SKIPPING, f'"{podcast_name} - {episode_name}" (EPISODE ALREADY EXISTS)')
+                    EventLog.emit('skipped', kind='episode', id=episode_id, path=episode_file_match, reason='exists')
+                    wait_between_downloads(); return
+                
+                time_start = time.time()
+                downloaded = 0
+                pos, pbar_stack = Printer.pbar_position_handler(1, pbar_stack)
+                with open(episode_path, 'wb') as file, Printer.pbar(
+                    desc=filename,
+                    total=total_size,
+                    unit='B',
+                    unit_scale=True,
+                    unit_divisor=1024,
+                    disable=not (show_pbar and Zotify.CONFIG.get_show_download_pbar()),
+                    pos=pos
+                ) as pbar:
+                    while True:
+                    #for _ in range(int(total_size / Zotify.CONFIG.get_chunk_size()) + 2):
+                        data = stream.input_stream.stream().read(Zotify.CONFIG.get_chunk_size())
+                        pbar.update(file.write(data))
+                        downloaded += len(data)
+                        if data == b'':
+                            break
+                        if Zotify.CONFIG.get_download_real_time():
+                            delta_real = time.time() - time_start
+                            delta_want = (downloaded / total_size) * (int(duration_ms)/1000)
+                            if delta_want > delta_real:
+                                Perf.sleep(delta_want - delta_real, 'realtime_wait')
+                
+                time_dl_end = time.time()
+                Perf.record('stream', time_dl_end - time_start)
+                Perf.count('stream_bytes', downloaded)
+                time_elapsed_dl = time_dl_end - time_start
+        else:
+            time_start = time.time()
+            try:
+                download_podcast_directly(direct_download_url, episode_path, show_pbar)
+            except Exception as e:
+                Printer.hashtaged(PrintChannel.ERROR, 'SKIPPING EPISODE - DIRECT DOWNLOAD FAILED\n' +\
                                                      f'Episode_ID: {str(episode_id)}')
+                Printer.traceback(e)
+                EventLog.emit('error', kind='episode', id=episode_id, stage='download', error=type(e).__name__)
+                if Path(episode_path).exists():
+                    Path(episode_path).unlink()
                 wait_between_downloads(); return
-            
-            episode_path_exists = False
-            total_size: int = stream.input_stream.size
-            for episode_file_match in Path(episode_path.parent).glob(episode_path.stem + ".*", case_sensitive=True):
-                episode_path_exists = episode_file_match.stat().st_size == total_size
-                if episode_path_exists: break
-            if episode_path_exists and Zotify.CONFIG.get_skip_existing():
-                Printer.hashtaged(PrintChannel.SKIPPING, f'"{podcast_name} - {episode_name}" (EPISODE ALREADY EXISTS)')
-                wait_between_downloads(); return
-            
-            time_start = time.time()
-            downloaded = 0
-            pos, pbar_stack = Printer.pbar_position_handler(1, pbar_stack)
-            with open(episode_path, 'wb') as file, Printer.pbar(
-                desc=filename,
-                total=total_size,
-                unit='B',
-                unit_scale=True,
-                unit_divisor=1024,
-                disable=not Zotify.CONFIG.get_show_download_pbar(),
-                pos=pos
-            ) as pbar:
-                while True:
-                #for _ in range(int(total_size / Zotify.CONFIG.get_chunk_size()) + 2):
-                    data = stream.input_stream.stream().read(Zotify.CONFIG.get_chunk_size())
-                    pbar.update(file.write(data))
-                    downloaded += len(data)
-                    if data == b'':
-                        break
-                    if Zotify.CONFIG.get_download_real_time():
-                        delta_real = time.time() - time_start
-                        delta_want = (downloaded / total_size) * (int(duration_ms)/1000)
-                        if delta_want > delta_real:
-                            time.sleep(delta_want - delta_real)
-            
-            time_dl_end = time.time()
-            time_elapsed_dl = fmt_duration(time_dl_end - time_start)
-        else:
-            # TODO add failure catch for after this function
-            download_podcast_directly(direct_download_url, episode_path)
+            Perf.record('stream', time.time() - time_start)
+            Perf.count('stream_bytes', Path(episode_path).stat().st_size)
+            time_elapsed_dl = time.time() - time_start
     
     Printer.hashtaged(PrintChannel.DOWNLOADS, f'DOWNLOADED: "{filename}"\n' +\
-                                              f'DOWNLOAD TOOK {time_elapsed_dl}')
+                                              f'DOWNLOAD TOOK {fmt_duration(time_elapsed_dl)}')
     
     try:
-        with Loader(PrintChannel.PROGRESS_INFO, "Identifying episode audio codec..."):
-            ff_m = ffmpy.FFprobe(
-                global_options=['-hide_banner', f'-loglevel {Zotify.CONFIG.get_ffmpeg_log_level()}'],
-                inputs={episode_path: ["-show_entries", "stream=codec_name"]},
-            )
-            stdout, _ = ff_m.run(stdout=subprocess.PIPE)
-            codec = stdout.decode().strip().split("=")[1].split("\r")[0].split("\n")[0]
-            
-            if codec in EXT_MAP:
-                suffix = EXT_MAP[codec]
-            else:
-                # gross, but shouldn't ever happen...
-                suffix = codec
-            
-            episode_path_codec = episode_path.with_suffix(f".{suffix}")
-            if Path(episode_path_codec).exists():
-                Path(episode_path_codec).unlink()
-            Path(episode_path).rename(episode_path_codec)
+        codec, _ = sniff_audio_file(episode_path)
+        if codec is None:
+            with Loader(PrintChannel.PROGRESS_INFO, "Identifying episode audio codec..."):
+                ff_m = ffmpy.FFprobe(
+                    global_options=['-hide_banner', f'-loglevel {Zotify.CONFIG.get_ffmpeg_log_level()}'],
+                    inputs={episode_path: ["-show_entries", "stream=codec_name"]},
+                )
+                stdout, _ = ff_m.run(stdout=subprocess.PIPE)
+                codec = stdout.decode().strip().split("=")[1].split("\r")[0].split("\n")[0]
+        
+        if codec in EXT_MAP:
+            suffix = EXT_MAP[codec]
+        else:
+            # gross, but shouldn't ever happen...
+            suffix = codec
+        
+        episode_path_codec = episode_path.with_suffix(f".{suffix}")
+        if Path(episode_path_codec).exists():
+            Path(episode_path_codec).unlink()
+        Path(episode_path).rename(episode_path_codec)
         
         Printer.debug(f"Detected Codec: {codec}\n" +\
                       f"File Renamed: {episode_path_codec.name}")
     
     except ffmpy.FFExecutableNotFoundError:
-        Path(episode_path).rename(episode_path.with_suffix(".mp3"))
+        episode_path_codec = episode_path.with_suffix(".mp3")
+        Path(episode_path).rename(episode_path_codec)
         Printer.hashtaged(PrintChannel.WARNING, 'FFMPEG NOT FOUND\n' +\
                                                 'SKIPPING CODEC ANALYSIS - OUTPUT ASSUMED MP3')
     
+    add_to_podcast_archive(episode_id, episode_path_codec.name, podcast_name, episode_name)
+    EventLog.emit('downloaded', kind='episode', id=episode_id, path=episode_path_codec,
+                  bytes=Path(episode_path_codec).stat().st_size, download_s=round(time_elapsed_dl, 3))
+    
     wait_between_downloads()
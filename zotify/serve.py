@@ -0,0 +1,248 @@
+import datetime
+import heapq
+import json
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from threading import Condition, Thread
+from typing import Callable
+
+from zotify.album import PARENT_ALBUMS, COMPLETED_ALBUMS
+from zotify.config import Zotify
+from zotify.termoutput import Printer, PrintChannel
+from zotify.transcode import TranscodePool
+
+
+class JobQueue:
+    """
+    Persistent priority queue of download jobs
+    
+    Jobs run one at a time on the warm session, highest priority first and in submission order within a priority.
+    The queue is written to disk on every change, so jobs that were queued or running when the daemon stopped
+    are picked up again on the next start.
+    """
+    JOBS: dict[str, dict] = {}
+    PENDING: list[tuple[int, int, str]] = []
+    SEQUENCE = 0
+    HISTORY = 200
+    COND = Condition()
+    
+    @classmethod
+    def _persist(cls) -> None:
+        queue_path = Path(Zotify.CONFIG.get_serve_queue_location())
+        temp_path = queue_path.with_suffix('.part')
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(list(cls.JOBS.values()), file, indent=4)
+        temp_path.replace(queue_path)
+    
+    @classmethod
+    def _push(cls, job: dict) -> None:
+        cls.SEQUENCE += 1
+        heapq.heappush(cls.PENDING, (-job['priority'], cls.SEQUENCE, job['id']))
+    
+    @classmethod
+    def load(cls) -> None:
+        queue_path = Path(Zotify.CONFIG.get_serve_queue_location())
+        if not queue_path.exists():
+            return
+        with open(queue_path, 'r', encoding='utf-8') as file:
+            jobs: list[dict] = json.load(file)
+        with cls.COND:
+            for job in sorted(jobs, key=lambda job: job['submitted']):
+                if job['status'] == 'running':
+                    # interrupted by the last shutdown
+                    job['status'] = 'queued'
+                    job['started'] = None
+                cls.JOBS[job['id']] = job
+                if job['status'] == 'queued':
+                    cls._push(job)
+            cls.COND.notify()
+        Printer.hashtaged(PrintChannel.MANDATORY, f'RESUMED {len(cls.PENDING)} QUEUED JOBS')
+    
+    @classmethod
+    def submit(cls, kind: str, priority: int = 0, urls: list[str] | None = None) -> dict:
+        job = {'id': uuid.uuid4().hex[:12],
+               'kind': kind,
+               'urls': urls,
+               'priority': priority,
+               'status': 'queued',
+               'submitted': time.time(),
+               'started': None,
+               'finished': None,
+               'error': None}
+        with cls.COND:
+            cls.JOBS[job['id']] = job
+            cls._push(job)
+            cls._persist()
+            cls.COND.notify()
+        return dict(job)
+    
+    @classmethod
+    def cancel(cls, job_id: str) -> dict | None:
+        """ Cancels a queued job, returns None if there is no such job """
+        with cls.COND:
+            job = cls.JOBS.get(job_id)
+            if job is not None and job['status'] == 'queued':
+                # its heap entry is dropped when popped
+                job['status'] = 'cancelled'
+                job['finished'] = time.time()
+                cls._persist()
+            return dict(job) if job is not None else None
+    
+    @classmethod
+    def get(cls, job_id: str) -> dict | None:
+        with cls.COND:
+            job = cls.JOBS.get(job_id)
+            return dict(job) if job is not None else None
+    
+    @classmethod
+    def jobs(cls) -> list[dict]:
+        with cls.COND:
+            return [dict(job) for job in cls.JOBS.values()]
+    
+    @classmethod
+    def next(cls, timeout: float | None = None) -> dict | None:
+        """ Blocks until a job is queued and marks it running, returns None on timeout """
+        with cls.COND:
+            while True:
+                while cls.PENDING:
+                    _, _, job_id = heapq.heappop(cls.PENDING)
+                    job = cls.JOBS[job_id]
+                    if job['status'] == 'queued':
+                        job['status'] = 'running'
+                        job['started'] = time.time()
+                        cls._persist()
+                        return job
+                if not cls.COND.wait(timeout):
+                    return None
+    
+    @classmethod
+    def finish(cls, job: dict, error: str | None = None) -> None:
+        with cls.COND:
+            job['status'] = 'failed' if error else 'done'
+            job['finished'] = time.time()
+            job['error'] = error
+            # keep only the most recent finished jobs
+            finished = [j for j in cls.JOBS.values() if j['status'] in {'done', 'failed', 'cancelled'}]
+            for old in sorted(finished, key=lambda j: j['finished'])[:max(len(finished) - cls.HISTORY, 0)]:
+                del cls.JOBS[old['id']]
+            cls._persist()
+    
+    @classmethod
+    def counts(cls) -> dict[str, int]:
+        with cls.COND:
+            counts = {}
+            for job in cls.JOBS.values():
+                counts[job['status']] = counts.get(job['status'], 0) + 1
+            return counts
+
+
+class ServeHandler(BaseHTTPRequestHandler):
+    KINDS: set[str] = set()
+    
+    def _reply(self, status: int, body: dict | list) -> None:
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def _job_id(self) -> str | None:
+        parts = self.path.split('?')[0].strip('/').split('/')
+        if len(parts) == 2 and parts[0] == 'jobs':
+            return parts[1]
+        return None
+    
+    def do_GET(self):
+        path = self.path.split('?')[0].rstrip('/')
+        if path == '/health':
+            self._reply(200, {'status': 'ok', 'jobs': JobQueue.counts()})
+        elif path == '/jobs':
+            self._reply(200, JobQueue.jobs())
+        elif self._job_id():
+            job = JobQueue.get(self._job_id())
+            if job is None:
+                self._reply(404, {'error': 'no such job'})
+            else:
+                self._reply(200, job)
+        else:
+            self._reply(404, {'error': 'not found'})
+    
+    def do_POST(self):
+        if self.path.split('?')[0].rstrip('/') != '/jobs':
+            self._reply(404, {'error': 'not found'})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            kind = body.get('kind', 'urls')
+            urls = body.get('urls')
+            priority = int(body.get('priority', 0))
+        except (ValueError, AttributeError) as e:
+            self._reply(400, {'error': f'invalid job: {e}'})
+            return
+        if kind not in self.KINDS:
+            self._reply(400, {'error': f'unknown kind, expected one of {sorted(self.KINDS)}'})
+            return
+        if urls is not None and not (isinstance(urls, list) and all(isinstance(url, str) for url in urls)):
+            self._reply(400, {'error': 'urls must be a list of strings'})
+            return
+        if kind == 'urls' and not urls:
+            self._reply(400, {'error': 'urls jobs need a non-empty list of urls'})
+            return
+        self._reply(202, JobQueue.submit(kind, priority, urls))
+    
+    def do_DELETE(self):
+        job = JobQueue.cancel(self._job_id()) if self._job_id() else None
+        if job is None:
+            self._reply(404, {'error': 'no such job'})
+        elif job['status'] != 'cancelled':
+            self._reply(409, job)
+        else:
+            self._reply(200, job)
+    
+    def log_message(self, format, *args):
+        pass
+
+
+def reset_run_state() -> None:
+    """ Clears the state a run keeps for its whole lifetime, so every job starts like a fresh run """
+    Zotify.DATETIME_LAUNCH = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    Zotify.LIKED_M3U8_CREATED = False
+    Zotify.LIKED_M3U8_MERGED = False
+    PARENT_ALBUMS.clear()
+    COMPLETED_ALBUMS.clear()
+
+
+def serve(handlers: dict[str, Callable[[dict], None]]) -> None:
+    """ Runs queued jobs on the current session until interrupted """
+    ServeHandler.KINDS = set(handlers)
+    JobQueue.load()
+    
+    address, port = Zotify.CONFIG.get_serve_address(), Zotify.CONFIG.get_serve_port()
+    server = ThreadingHTTPServer((address, port), ServeHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True, name="zotify-serve").start()
+    Printer.hashtaged(PrintChannel.MANDATORY, f'ACCEPTING JOBS ON http://{address}:{port}/jobs')
+    
+    try:
+        while True:
+            # the timeout keeps the main thread responsive to KeyboardInterrupt
+            job = JobQueue.next(timeout=1)
+            if job is None:
+                continue
+            Printer.hashtaged(PrintChannel.MANDATORY, f'STARTING JOB {job["id"]} ({job["kind"]})')
+            reset_run_state()
+            try:
+                handlers[job['kind']](job)
+                TranscodePool.join()
+            except Exception as e:
+                Printer.hashtaged(PrintChannel.ERROR, f'JOB {job["id"]} FAILED')
+                Printer.traceback(e)
+                JobQueue.finish(job, f'{type(e).__name__}: {e}')
+            else:
+                JobQueue.finish(job)
+                Printer.hashtaged(PrintChannel.MANDATORY, f'FINISHED JOB {job["id"]}')
+    finally:
+        server.shutdown()
@@ -1,17 +1,19 @@
 from __future__ import annotations
 import platform
-from os import get_terminal_size, system
+from os import system
+from shutil import get_terminal_size
 from itertools import cycle
 from time import sleep
 from pprint import pformat
 from tabulate import tabulate
-from threading import Thread
+from threading import Lock, Thread
 from traceback import TracebackException
 from enum import Enum
 from tqdm import tqdm
 from mutagen import FileType
 
 from zotify.const import *
+from zotify.perf import Perf
 
 
 UP_ONE_LINE = "\033[A"
@@ -49,17 +51,21 @@ class PrintCategory(Enum):
 
 LAST_PRINT: PrintCategory = PrintCategory.NONE
 ACTIVE_LOADER: Loader | None = None
+LOADER_STACK: list[Loader] = []
+LOADER_LOCK = Lock()
 ACTIVE_PBARS: list[tqdm] = []
 
 
 class Printer:
     @staticmethod
     def _term_cols() -> int:
-        try:
-            columns, _ = get_terminal_size()
-        except OSError:
-            columns = 80
-        return columns
+        # queried per print so a resized window is picked up, falls back to 80 columns without a terminal
+        return get_terminal_size().columns
+    
+    @staticmethod
+    def _headless() -> bool:
+        from zotify.config import Zotify
+        return bool(Zotify.CONFIG.get(HEADLESS))
     
     @staticmethod
     def _api_shrink(obj: list | tuple | dict) -> dict:
@@ -110,7 +116,8 @@ class Printer:
         if LAST_PRINT is PrintCategory.DEBUG and category is PrintCategory.DEBUG:
             pass
         elif LAST_PRINT in {PrintCategory.LOADER, PrintCategory.LOADER_CYCLE} and category is PrintCategory.LOADER:
-            msg = "\n" + PrintCategory.LOADER_CYCLE.value + msg
+            # headless output is never rewritten in place, so consecutive loaders just stack
+            msg = ("\t" if Printer._headless() else "\n" + PrintCategory.LOADER_CYCLE.value) + msg
         elif LAST_PRINT in {PrintCategory.LOADER, PrintCategory.LOADER_CYCLE} and "LOADER" not in category.name:
             msg = category.value.replace("\n", "", 1) + msg
         else:
@@ -120,12 +127,12 @@ class Printer:
     
     @staticmethod
     def _toggle_active_loader(skip_toggle: bool = False):
-        global ACTIVE_LOADER
-        if not skip_toggle and ACTIVE_LOADER:
-            if ACTIVE_LOADER.paused:
-                ACTIVE_LOADER.resume()
+        loader = ACTIVE_LOADER
+        if not skip_toggle and loader:
+            if loader.paused:
+                loader.resume()
             else:
-                ACTIVE_LOADER.pause()
+                loader.pause()
     
     @staticmethod
     def new_print(channel: PrintChannel, msg: str, category: PrintCategory = PrintCategory.NONE, skip_toggle: bool = False, end: str = "\n") -> None:
@@ -137,8 +144,11 @@ class Printer:
             if channel == PrintChannel.DEBUG and Zotify.CONFIG.logger:
                 Zotify.CONFIG.logger.debug(msg.strip().replace("DEBUG", "\n") + "\n")
             Printer._toggle_active_loader(skip_toggle)
+            headless = Printer._headless()
             for line in str(msg).splitlines():   
-                if end == "\n": 
+                if end == "\n" and headless:
+                    tqdm.write(line)
+                elif end == "\n": 
                     tqdm.write(line.ljust(Printer._term_cols()))
                 else:
                     tqdm.write(line, end=end)
@@ -229,6 +239,8 @@ class Printer:
             disable=False, unit_scale=False, unit_divisor=1000, pos=1) -> tqdm:
         if iterable and len(iterable) == 1 and len(ACTIVE_PBARS) > 0:
             disable = True # minimize clutter
+        if Printer._headless():
+            disable = True
         new_pbar = tqdm(iterable=iterable, desc=desc, total=total, disable=disable, position=pos, 
                         unit=unit, unit_scale=unit_scale, unit_divisor=unit_divisor, leave=False)
         if new_pbar.disable: new_pbar.pos = -pos
@@ -285,7 +297,9 @@ class Loader:
         self.channel = chan
         self.category = PrintCategory.LOADER
         
-        self._thread = Thread(target=self._animate, daemon=True)
+        # headless loaders print their description once, with no animation thread or sleeps
+        self.headless = Printer._headless()
+        self._thread = None if self.headless else Thread(target=self._animate, daemon=True)
         if mode == 'std1':
             self.steps = ["⢿", "⣻", "⣽", "⣾", "⣷", "⣯", "⣟", "⡿"]
         elif mode == 'std2':
@@ -307,17 +321,24 @@ class Loader:
     
     def store_active_loader(self):
         global ACTIVE_LOADER
-        self._inherited_active_loader = ACTIVE_LOADER
-        ACTIVE_LOADER = self
+        with LOADER_LOCK:
+            LOADER_STACK.append(self)
+            ACTIVE_LOADER = self
     
     def release_active_loader(self):
         global ACTIVE_LOADER
-        ACTIVE_LOADER = self._inherited_active_loader
+        with LOADER_LOCK:
+            # loaders on worker threads may finish in any order, not just innermost first
+            LOADER_STACK.remove(self)
+            ACTIVE_LOADER = LOADER_STACK[-1] if LOADER_STACK else None
     
     def start(self):
         self.store_active_loader()
+        if self.headless:
+            self._loader_print(self.desc)
+            return self
         self._thread.start()
-        sleep(self.timeout*2) #guarantee _animate can print at least once
+        Perf.sleep(self.timeout*2, 'loader_wait') #guarantee _animate can print at least once
         return self
     
     def _animate(self):
@@ -334,8 +355,10 @@ class Loader:
     
     def stop(self):
         self.done = True
+        if self.headless:
+            self.dead = True
         while not self.dead: #guarantee _animate has finished
-            sleep(self.timeout) 
+            Perf.sleep(self.timeout, 'loader_wait')
         self.category = PrintCategory.LOADER
         if self.end != "":
             self._loader_print(self.end)
@@ -347,7 +370,8 @@ class Loader:
     def resume(self):
         self.category = PrintCategory.LOADER
         self.paused = False
-        sleep(self.timeout*2) #guarantee _animate can print at least once
+        if not self.headless:
+            Perf.sleep(self.timeout*2, 'loader_wait') #guarantee _animate can print at least once
     
     def __exit__(self, exc_type, exc_value, tb):
         # handle exceptions with those variables ^
@@ -2,20 +2,31 @@ import time
 import uuid
 import ffmpy
 import shutil
+import subprocess
+from contextlib import nullcontext
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path, PurePath
 from librespot.metadata import TrackId
 
 from zotify import __version__
+from zotify.cache import LyricsCache
 from zotify.config import Zotify
 from zotify.const import TRACKS, ALBUM, GENRES, NAME, DISC_NUMBER, TRACK_NUMBER, TOTAL_TRACKS, \
-    IS_PLAYABLE, ARTISTS, ARTIST_IDS, IMAGES, URL, RELEASE_DATE, ID, TRACK_URL, \
+    IS_PLAYABLE, ARTISTS, ARTIST_IDS, IMAGES, URL, RELEASE_DATE, ID, TRACK_BULK_URL, \
     CODEC_MAP, DURATION_MS, WIDTH, COMPILATION, ALBUM_TYPE, ARTIST_BULK_URL, YEAR, \
-    ALBUM_ARTISTS, IMAGE_URL, EXPORT_M3U8
+    ALBUM_ARTISTS, IMAGE_URL, ERROR, LYRICS
+from zotify.events import EventLog
+from zotify.perf import Perf
 from zotify.termoutput import Printer, PrintChannel, Loader
-from zotify.utils import fill_output_template, set_audio_tags, set_music_thumbnail, create_download_directory, \
+from zotify.transcode import TranscodePool
+from zotify.utils import fill_output_template, set_audio_tags, get_music_thumbnail, save_music_thumbnail, create_download_directory, \
     add_to_m3u8, fetch_m3u8_songs, get_directory_song_ids, add_to_directory_song_archive, \
     get_archived_song_ids, add_to_song_archive, fmt_duration, wait_between_downloads, conv_artist_format, \
-    conv_genre_format, compare_audio_tags, fix_filename
+    conv_genre_format, compare_audio_tags, fix_filename, is_ogg_file
+
+
+PREFETCH_POOL = ThreadPoolExecutor(max_workers=3, thread_name_prefix="zotify-prefetch")
 
 
 def parse_track_metadata(track_resp: dict) -> dict[str, list[str] | str | int | bool]:
@@ -51,7 +62,7 @@ def parse_track_metadata(track_resp: dict) -> dict[str, list[str] | str | int |
 def get_track_metadata(track_id) -> dict[str, list[str] | str | int | bool]:
     """ Retrieves metadata for downloaded songs """
     with Loader(PrintChannel.PROGRESS_INFO, "Fetching track information..."):
-        (raw, info) = Zotify.invoke_url(f'{TRACK_URL}?ids={track_id}&market=from_token')
+        (raw, info) = Zotify.invoke_url(TRACK_BULK_URL + track_id)
         
         if not TRACKS in info:
             raise ValueError(f'Invalid response from TRACK_URL:\n{raw}')
@@ -62,16 +73,23 @@ def get_track_metadata(track_id) -> dict[str, list[str] | str | int | bool]:
             raise ValueError(f'Failed to parse TRACK_URL response: {str(e)}\n{raw}')
 
 
-def get_track_genres(artist_ids: list[str], track_name: str) -> list[str]:
+def fetch_artist_genres(artist_ids: list[str]) -> set[str]:
+    artists = Zotify.invoke_url_bulk(ARTIST_BULK_URL, artist_ids, ARTISTS)
+    
+    genres = set()
+    for artist in artists:
+        if GENRES in artist and len(artist[GENRES]) > 0:
+            genres.update(artist[GENRES])
+    return genres
+
+
+def get_track_genres(artist_ids: list[str], track_name: str, prefetched: Future | None = None) -> list[str]:
     if Zotify.CONFIG.get_save_genres():
         with Loader(PrintChannel.PROGRESS_INFO, "Fetching genre information..."):
-            
-            artists = Zotify.invoke_url_bulk(ARTIST_BULK_URL, artist_ids, ARTISTS)
-            
-            genres = set()
-            for artist in artists:
-                if GENRES in artist and len(artist[GENRES]) > 0:
-                    genres.update(artist[GENRES])
+            if prefetched is not None:
+                genres = prefetched.result()
+            else:
+                genres = fetch_artist_genres(artist_ids)
         
         if len(genres) == 0:
             Printer.hashtaged(PrintChannel.WARNING, 'NO GENRES FOUND\n' +\
@@ -87,13 +105,34 @@ def get_track_genres(artist_ids: list[str], track_name: str) -> list[str]:
         return ['']
 
 
+def prefetch_track_extras(track_metadata: dict) -> dict[str, Future]:
+    """ Starts fetching a track's genres, lyrics and artwork in the background, to be joined before tagging """
+    prefetched = {}
+    if Zotify.CONFIG.get_save_genres():
+        prefetched[GENRES] = PREFETCH_POOL.submit(fetch_artist_genres, track_metadata[ARTIST_IDS])
+    if Zotify.CONFIG.get_download_lyrics() or Zotify.CONFIG.get_always_check_lyrics():
+        prefetched[LYRICS] = PREFETCH_POOL.submit(get_track_lyrics, track_metadata[ID])
+    # result is held by ArtworkCache until the track is tagged
+    prefetched[IMAGE_URL] = PREFETCH_POOL.submit(get_music_thumbnail, track_metadata[IMAGE_URL], embedded=True)
+    return prefetched
+
+
 def get_track_lyrics(track_id: str) -> list[str]:
+    cached, cached_lyrics = LyricsCache.get(track_id)
+    if cached:
+        if cached_lyrics is None:
+            raise ValueError(f'Failed to fetch lyrics: {track_id} (cached as unavailable)')
+        return cached_lyrics
+    
     # expect failure here, lyrics are not guaranteed to be available
     (raw, lyrics_dict) = Zotify.invoke_url('https://spclient.wg.spot' + f'ify.com/color-lyrics/v2/track/{track_id}', expectFail=True)
     if lyrics_dict:
         try:
             formatted_lyrics = lyrics_dict['lyrics']['lines']
         except KeyError:
+            if lyrics_dict.get(ERROR, {}).get('status') == 404:
+                # only a definitive "no lyrics" is remembered, other failures may be transient
+                LyricsCache.put(track_id, None)
             raise ValueError(f'Failed to fetch lyrics: {track_id}')
         
         if(lyrics_dict['lyrics']['syncType'] == "UNSYNCED"):
@@ -107,11 +146,12 @@ def get_track_lyrics(track_id: str) -> list[str]:
                 tss.append(f"{timestamp}".zfill(5) + f" {ts.split(':')[0]} {ts.split(':')[1].replace('.', ' ')}\n")
                 lyrics.append(f'[{ts}]' + line['words'] + '\n')
             # Printer.debug("Synced Lyric Timestamps:\n" + "".join(tss))
+        LyricsCache.put(track_id, lyrics)
         return lyrics
     raise ValueError(f'Failed to fetch lyrics: {track_id}')
 
 
-def handle_lyrics(track_id: str, filedir: PurePath, track_metadata: dict) -> list[str] | None:
+def handle_lyrics(track_id: str, filedir: PurePath, track_metadata: dict, prefetched: Future | None = None) -> list[str] | None:
     lyrics = None
     if not Zotify.CONFIG.get_download_lyrics() and not Zotify.CONFIG.get_always_check_lyrics():
         return lyrics
@@ -125,7 +165,10 @@ def handle_lyrics(track_id: str, filedir: PurePath, track_metadata: dict) -> lis
             
             Path(lyricdir).mkdir(parents=True, exist_ok=True)
             
-            lyrics = get_track_lyrics(track_id)
+            if prefetched is not None:
+                lyrics = prefetched.result()
+            else:
+                lyrics = get_track_lyrics(track_id)
             
             lrc_header = [f"[ti: {track_metadata[NAME]}]\n",
                           f"[ar: {conv_artist_format(track_metadata[ARTISTS], FORCE_NO_LIST=True)}]\n",
@@ -144,6 +187,17 @@ def handle_lyrics(track_id: str, filedir: PurePath, track_metadata: dict) -> lis
     return lyrics
 
 
+def get_track_artwork(image_url: str, embedded: bool = False) -> bytes | None:
+    """ Returns the album cover, or None if it could not be fetched so the remaining tags can still be written """
+    try:
+        return get_music_thumbnail(image_url, embedded)
+    except Exception as e:
+        Printer.hashtaged(PrintChannel.WARNING, 'FAILED TO FETCH ALBUM ART\n' +\
+                                               f'Image_URL: {image_url}')
+        Printer.traceback(e)
+        return None
+
+
 def update_track_metadata(track_id: str, track_path: Path, track_resp: dict) -> None:
     track_metadata = parse_track_metadata(track_resp)
     (scraped_track_id, track_name, artists, artist_ids, release_date, release_year, track_number, total_tracks,
@@ -164,10 +218,12 @@ def update_track_metadata(track_id: str, track_path: Path, track_resp: dict) ->
                                                    '(NO UPDATES REQUIRED)')
         return
     
+    Printer.debug(f'Metadata Mismatches:', mismatches)
+    artwork = get_track_artwork(track_metadata[IMAGE_URL], embedded=True)
     try:
-        Printer.debug(f'Metadata Mismatches:', mismatches)
-        set_audio_tags(track_path, track_metadata, total_discs, genres, lyrics)
-        set_music_thumbnail(track_path, track_metadata[IMAGE_URL], mode="single")
+        set_audio_tags(track_path, track_metadata, total_discs, genres, lyrics, artwork)
+        if artwork is not None:
+            save_music_thumbnail(track_path, get_music_thumbnail(track_metadata[IMAGE_URL]), mode="single")
         Printer.hashtaged(PrintChannel.DOWNLOADS, f'VERIFIED:  METADATA FOR "{track_path.relative_to(Zotify.CONFIG.get_root_path())}"\n' +\
                                                   f'(UPDATED TAGS TO MATCH CURRENT API METADATA)')
     except Exception as e:
@@ -176,30 +232,24 @@ def update_track_metadata(track_id: str, track_path: Path, track_resp: dict) ->
         Printer.traceback(e)
 
 
-def download_track(mode: str, track_id: str, extra_keys: dict | None = None, pbar_stack: list | None = None) -> None:
-    """ Downloads raw song audio content stream"""
+def download_track(mode: str, track_id: str, extra_keys: dict | None = None, pbar_stack: list | None = None) -> bool:
+    """ Downloads raw song audio content stream, returns False if the track failed and should be retried later """
     
     # recursive header for parent album download
     child_request_mode = mode
     child_request_id = track_id
+    requester_keys = extra_keys # receives the track's final path as 'track_path'
     if Zotify.CONFIG.get_download_parent_album():
-        if mode == "album" and "M3U8_bypass" in extra_keys and extra_keys["M3U8_bypass"] is not None:
-            child_request_mode, child_request_id = extra_keys.pop("M3U8_bypass")
+        if mode == "album":
+            # already downloading as part of an album, handle m3u8 as if only the originally requested track was downloaded
+            if extra_keys and extra_keys.get("M3U8_bypass") is not None:
+                child_request_mode, child_request_id = extra_keys.pop("M3U8_bypass")
+                requester_keys = extra_keys.pop("requester_keys", None)
         else:
-            album_id = total_tracks = None
-            try:
-                (raw, info) = Zotify.invoke_url(f'{TRACK_URL}?ids={track_id}&market=from_token')
-                album_id = info[TRACKS][0][ALBUM][ID]
-                total_tracks = info[TRACKS][0][ALBUM][TOTAL_TRACKS]
-            except:
-                Printer.hashtaged(PrintChannel.ERROR, 'FAILED TO FIND PARENT ALBUM\n' +\
-                                                     f'Track_ID: {track_id}')
-            
-            if album_id and total_tracks and int(total_tracks) > 1:
-                from zotify.album import download_album
-                # uses album OUTPUT template for track_path formatting, but handle m3u8 as if only this track was downloaded
-                download_album(album_id, pbar_stack, M3U8_bypass=(mode, track_id))
-                return
+            from zotify.album import download_parent_album
+            finished = download_parent_album(mode, track_id, pbar_stack, extra_keys)
+            if finished is not None:
+                return finished
     
     if extra_keys is None:
         extra_keys = {}
@@ -223,7 +273,8 @@ def download_track(mode: str, track_id: str, extra_keys: dict | None = None, pba
                     Printer.hashtaged(PrintChannel.SKIPPING, 'TRACK MATCHES REGEX FILTER\n' +\
                                                             f'Track_Name: {track_name} - Track_ID: {track_id}\n'+\
                                                         (f'Regex Groups: {regex_match.groupdict()}\n' if regex_match.groups() else ""))
-                    return
+                    EventLog.emit('skipped', kind='track', id=track_id, reason='regex')
+                    return True
             
             output_template = Zotify.CONFIG.get_output(mode)
             root_to_track, track_label = fill_output_template(output_template, track_metadata, extra_keys)
@@ -238,6 +289,10 @@ def download_track(mode: str, track_id: str, extra_keys: dict | None = None, pba
             track_path_exists = Path(track_path).is_file() and Path(track_path).stat().st_size
             in_dir_songids = track_metadata[ID] in get_directory_song_ids(filedir)
             in_global_songids = track_metadata[ID] in get_archived_song_ids()
+            # downloaded earlier this run, archived once its background conversion finishes
+            if TranscodePool.in_flight(track_metadata[ID]):
+                in_global_songids = True
+                in_dir_songids = in_dir_songids or TranscodePool.in_flight(track_metadata[ID], filedir)
             Printer.debug("Duplicate Check\n" +\
                          f"File Already Exists: {track_path_exists}\n" +\
                          f"song_id in Local Archive: {in_dir_songids}\n" +\
@@ -249,16 +304,21 @@ def download_track(mode: str, track_id: str, extra_keys: dict | None = None, pba
                 track_path = PurePath(filedir).joinpath(f'{track_path.stem}_{c}{track_path.suffix}')
                 track_path_exists = False # new track_path guaranteed to be unique
             
+            if requester_keys is not None and track_id == child_request_id:
+                requester_keys['track_path'] = track_path
+            
             liked_m3u8 = child_request_mode == "liked" and Zotify.CONFIG.get_liked_songs_archive_m3u8()
-            if Zotify.CONFIG.get_export_m3u8() and track_id == child_request_id:
-                m3u8_path: PurePath | None = extra_keys['m3u8_path'] if 'm3u8_path' in extra_keys else None
+            # once merged, the rest of the liked songs are already in Liked Songs.m3u8
+            if Zotify.CONFIG.get_export_m3u8() and track_id == child_request_id and not (liked_m3u8 and Zotify.LIKED_M3U8_MERGED):
+                # a track fetched with its parent album still belongs in the requester's playlist file
+                m3u8_path: PurePath | None = (requester_keys or extra_keys).get('m3u8_path')
                 if liked_m3u8:
                     m3u8_path = filedir / "Liked Songs.m3u8"
                     songs_m3u = fetch_m3u8_songs(m3u8_path)
                 track_m3u8_label = add_to_m3u8(track_metadata[DURATION_MS], track_label, track_path, m3u8_path)
-                if liked_m3u8:
+                if liked_m3u8 and not Zotify.LIKED_M3U8_CREATED:
                     if songs_m3u is not None and track_m3u8_label in songs_m3u[0]:
-                        Zotify.CONFIG.Values[EXPORT_M3U8] = False
+                        Zotify.LIKED_M3U8_MERGED = True
                         Path(filedir / (Zotify.DATETIME_LAUNCH + "_zotify.m3u8")).replace(m3u8_path)
                         with open(m3u8_path, 'a', encoding='utf-8') as file:
                             file.writelines(songs_m3u[3:])
@@ -271,37 +331,52 @@ def download_track(mode: str, track_id: str, extra_keys: dict | None = None, pba
                                              f'Track_ID: {track_id}')
         Printer.json_dump(extra_keys)
         Printer.traceback(e)
+        EventLog.emit('error', kind='track', id=track_id, stage='metadata', error=type(e).__name__)
+        return False
     
     else:
+        ff_proc = None
         try:
             if not track_metadata[IS_PLAYABLE]:
                 Printer.hashtaged(PrintChannel.SKIPPING, f'"{track_label}" (TRACK IS UNAVAILABLE)')
+                EventLog.emit('skipped', kind='track', id=track_id, reason='unavailable')
             else:
                 if track_path_exists and Zotify.CONFIG.get_skip_existing() and Zotify.CONFIG.get_disable_directory_archives():
                     Printer.hashtaged(PrintChannel.SKIPPING, f'"{PurePath(track_path).relative_to(Zotify.CONFIG.get_root_path())}" (FILE ALREADY EXISTS)')
+                    EventLog.emit('skipped', kind='track', id=track_id, path=track_path, reason='exists')
                 
                 elif in_dir_songids and Zotify.CONFIG.get_skip_existing() and not Zotify.CONFIG.get_disable_directory_archives():
                     Printer.hashtaged(PrintChannel.SKIPPING, f'"{track_label}" (TRACK ALREADY EXISTS)')
+                    EventLog.emit('skipped', kind='track', id=track_id, path=track_path, reason='exists')
                 
                 elif in_global_songids and Zotify.CONFIG.get_skip_previously_downloaded():
                     Printer.hashtaged(PrintChannel.SKIPPING, f'"{track_label}" (TRACK ALREADY DOWNLOADED ONCE)')
+                    EventLog.emit('skipped', kind='track', id=track_id, reason='archived')
                 
                 else:
                     if track_id != track_metadata[ID]:
                         track_id = track_metadata[ID]
+                    # auxiliary metadata only depends on track_metadata, fetch it while the audio downloads
+                    prefetched = prefetch_track_extras(track_metadata)
+                    
                     track = TrackId.from_base62(track_id)
                     stream = Zotify.get_content_stream(track, Zotify.DOWNLOAD_QUALITY)
                     if stream is None:
                         Printer.hashtaged(PrintChannel.ERROR, 'SKIPPING SONG - FAILED TO GET CONTENT STREAM\n' +\
                                                              f'Track_ID: {track_id}')
-                        return
+                        EventLog.emit('error', kind='track', id=track_id, stage='stream', error='NoContentStream')
+                        return False
                     create_download_directory(filedir)
                     total_size = stream.input_stream.size
                     
+                    if Zotify.CONFIG.get_stream_transcode() and get_ffmpeg_output_params()[0] != 'copy':
+                        # convert while downloading, the raw stream never touches the disk
+                        ff_proc = open_ffmpeg_pipe(track_path_temp)
+                    
                     time_start = time.time()
                     downloaded = 0
                     pos, pbar_stack = Printer.pbar_position_handler(1, pbar_stack)
-                    with open(track_path_temp, 'wb') as file, Printer.pbar(
+                    with ff_proc.stdin if ff_proc else open(track_path_temp, 'wb') as file, Printer.pbar(
                             desc=track_label,
                             total=total_size,
                             unit='B',
@@ -321,55 +396,86 @@ def download_track(mode: str, track_id: str, extra_keys: dict | None = None, pba
                                 delta_real = time.time() - time_start
                                 delta_want = (downloaded / total_size) * (track_metadata[DURATION_MS]/1000)
                                 if delta_want > delta_real:
-                                    time.sleep(delta_want - delta_real)
+                                    Perf.sleep(delta_want - delta_real, 'realtime_wait')
                     
                     time_dl_end = time.time()
-                    time_elapsed_dl = fmt_duration(time_dl_end - time_start)
+                    Perf.record('stream', time_dl_end - time_start)
+                    Perf.count('stream_bytes', downloaded)
+                    time_elapsed_dl = time_dl_end - time_start
                     
-                    genres = get_track_genres(track_metadata[ARTIST_IDS], track_name)
+                    genres = get_track_genres(track_metadata[ARTIST_IDS], track_name, prefetched.get(GENRES))
                     
-                    lyrics = handle_lyrics(track_id, filedir, track_metadata)
+                    lyrics = handle_lyrics(track_id, filedir, track_metadata, prefetched.get(LYRICS))
                     
                     # no metadata is written to track prior to conversion
-                    time_elapsed_ffmpeg = convert_audio_format(track_path_temp)
-
-                    if track_path_temp != track_path:
-                        if Path(track_path).exists():
-                            Path(track_path).unlink()
-                        shutil.move(str(track_path_temp), str(track_path))
-                    
-                    try:
-                        set_audio_tags(track_path, track_metadata, total_discs, genres, lyrics)
-                        set_music_thumbnail(track_path, track_metadata[IMAGE_URL], mode)
-                    except Exception as e:
-                        Printer.hashtaged(PrintChannel.ERROR, 'FAILED TO WRITE METADATA\n' +\
-                                                              'Ensure FFMPEG is installed and added to your PATH')
-                        Printer.traceback(e)
+                    if ff_proc:
+                        time_elapsed_ffmpeg = finish_ffmpeg_pipe(ff_proc, time_dl_end)
+                    elif TranscodePool.enabled() and get_ffmpeg_output_params()[0] != 'copy':
+                        # conversion, tagging and archiving finish in the background while the next track downloads
+                        TranscodePool.submit(partial(convert_audio_format, show_loader=False), track_path_temp,
+                                             partial(finalize_track, track_path_temp, track_path, track_metadata, mode,
+                                                     total_discs, genres, lyrics, in_global_songids, in_dir_songids,
+                                                     time_elapsed_dl),
+                                             track_id, filedir)
+                        wait_between_downloads()
+                        return True
+                    else:
+                        time_elapsed_ffmpeg = convert_audio_format(track_path_temp)
                     
-                    Printer.hashtaged(PrintChannel.DOWNLOADS, f'DOWNLOADED: "{PurePath(track_path).relative_to(Zotify.CONFIG.get_root_path())}"\n' +\
-                                                              f'DOWNLOAD TOOK {time_elapsed_dl} (PLUS {time_elapsed_ffmpeg} CONVERTING)')
-                    
-                    if not in_global_songids:
-                        add_to_song_archive(track_metadata[ID], PurePath(track_path).name, track_metadata[ARTISTS][0], track_name)
-                    if not in_dir_songids:
-                        add_to_directory_song_archive(track_path, track_metadata[ID], track_metadata[ARTISTS][0], track_name)
+                    finalize_track(track_path_temp, track_path, track_metadata, mode, total_discs, genres, lyrics,
+                                   in_global_songids, in_dir_songids, time_elapsed_dl, time_elapsed_ffmpeg)
                     
                     wait_between_downloads()
+            return True
             
         except Exception as e:
             Printer.hashtaged(PrintChannel.ERROR, 'SKIPPING SONG - GENERAL DOWNLOAD ERROR\n' +\
                                                  f'Track_Label: {track_label} - Track_ID: {track_id}')
             Printer.json_dump(extra_keys)
             Printer.traceback(e)
+            EventLog.emit('error', kind='track', id=track_id, stage='download', error=type(e).__name__)
+            if ff_proc and ff_proc.poll() is None:
+                ff_proc.kill()
+                ff_proc.wait()
             if Path(track_path_temp).exists():
                 Path(track_path_temp).unlink()
+            return False
 
 
-def convert_audio_format(track_path) -> None:
-    """ Converts raw audio into playable file """
-    temp_track_path = f'{PurePath(track_path).parent}.tmp'
-    shutil.move(str(track_path), temp_track_path)
+def finalize_track(track_path_temp: PurePath, track_path: PurePath, track_metadata: dict, mode: str,
+                   total_discs: str | None, genres: list[str], lyrics: list[str] | None,
+                   in_global_songids: bool, in_dir_songids: bool, time_elapsed_dl: float, time_elapsed_ffmpeg: float | None) -> None:
+    """ Moves a converted track into place, writes its metadata and records it in the archives """
+    if track_path_temp != track_path:
+        if Path(track_path).exists():
+            Path(track_path).unlink()
+        shutil.move(str(track_path_temp), str(track_path))
+    
+    artwork = get_track_artwork(track_metadata[IMAGE_URL], embedded=True)
+    try:
+        set_audio_tags(track_path, track_metadata, total_discs, genres, lyrics, artwork)
+        if artwork is not None:
+            save_music_thumbnail(track_path, get_music_thumbnail(track_metadata[IMAGE_URL]), mode)
+    except Exception as e:
+        Printer.hashtaged(PrintChannel.ERROR, 'FAILED TO WRITE METADATA\n' +\
+                                              'Ensure FFMPEG is installed and added to your PATH')
+        Printer.traceback(e)
+    
+    Printer.hashtaged(PrintChannel.DOWNLOADS, f'DOWNLOADED: "{PurePath(track_path).relative_to(Zotify.CONFIG.get_root_path())}"\n' +\
+                                              f'DOWNLOAD TOOK {fmt_duration(time_elapsed_dl)} ' +\
+                                             (f'(PLUS {fmt_duration(time_elapsed_ffmpeg)} CONVERTING)' if time_elapsed_ffmpeg is not None else '(NO CONVERSION NEEDED)'))
+    EventLog.emit('downloaded', kind='track', id=track_metadata[ID], path=track_path,
+                  bytes=Path(track_path).stat().st_size if Path(track_path).exists() else None,
+                  download_s=round(time_elapsed_dl, 3), convert_s=round(time_elapsed_ffmpeg, 3) if time_elapsed_ffmpeg is not None else None)
     
+    if not in_global_songids:
+        add_to_song_archive(track_metadata[ID], PurePath(track_path).name, track_metadata[ARTISTS][0], track_metadata[NAME])
+    if not in_dir_songids:
+        add_to_directory_song_archive(track_path, track_metadata[ID], track_metadata[ARTISTS][0], track_metadata[NAME])
+
+
+def get_ffmpeg_output_params() -> tuple[str, list[str]]:
+    """ Returns the target codec and FFMPEG output parameters for the configured download format """
     download_format = Zotify.CONFIG.get_download_format().lower()
     file_codec = CODEC_MAP.get(download_format, 'copy')
     bitrate = None
@@ -388,6 +494,23 @@ def convert_audio_format(track_path) -> None:
     if bitrate is not None:
         output_params += ['-b:a', bitrate]
     
+    return file_codec, output_params
+
+
+def convert_audio_format(track_path, show_loader: bool = True) -> float | None:
+    """ Converts raw audio into playable file, returns seconds spent converting or None if the raw audio is already playable """
+    file_codec, output_params = get_ffmpeg_output_params()
+    
+    if file_codec == 'copy' and is_ogg_file(track_path):
+        # raw stream is already an Ogg Vorbis file, remuxing would only rewrite identical audio
+        Zotify.FFMPEG_SKIPS += 1
+        Zotify.FFMPEG_SKIPPED_BYTES += Path(track_path).stat().st_size
+        return None
+    
+    # unique per track, conversions may run concurrently within the same directory
+    temp_track_path = str(PurePath(track_path).with_suffix('.tmp'))
+    shutil.move(str(track_path), temp_track_path)
+    
     time_ffmpeg_start = time.time()
     try:
         ff_m = ffmpy.FFmpeg(
@@ -395,7 +518,7 @@ def convert_audio_format(track_path) -> None:
             inputs={temp_track_path: None},
             outputs={track_path: output_params}
         )
-        with Loader(PrintChannel.PROGRESS_INFO, "Converting file..."):
+        with Loader(PrintChannel.PROGRESS_INFO, "Converting file...") if show_loader else nullcontext():
             ff_m.run()
         
         if Path(temp_track_path).exists():
@@ -407,6 +530,38 @@ def convert_audio_format(track_path) -> None:
         else:
             reason = str(e) + "\n"
         Printer.hashtaged(PrintChannel.WARNING, reason + f'SKIPPING CONVERSION TO {file_codec.upper()}')
+        # keep the unconverted audio over any partial output rather than leaving it orphaned as .tmp
+        if Path(temp_track_path).exists():
+            Path(temp_track_path).replace(track_path)
     
     time_ffmpeg_end = time.time()
-    return fmt_duration(time_ffmpeg_end - time_ffmpeg_start)
+    Perf.record('convert', time_ffmpeg_end - time_ffmpeg_start)
+    return time_ffmpeg_end - time_ffmpeg_start
+
+
+def open_ffmpeg_pipe(track_path: PurePath) -> subprocess.Popen | None:
+    """ Starts an FFMPEG process converting audio written to its stdin, returns None if FFMPEG is unavailable """
+    file_codec, output_params = get_ffmpeg_output_params()
+    
+    command = ['ffmpeg', '-y', '-hide_banner', '-loglevel', Zotify.CONFIG.get_ffmpeg_log_level(),
+               '-i', 'pipe:0', *output_params, str(track_path)]
+    try:
+        return subprocess.Popen(command, stdin=subprocess.PIPE)
+    except FileNotFoundError:
+        Printer.hashtaged(PrintChannel.WARNING, 'FFMPEG NOT FOUND\n' +\
+                                                'FALLING BACK TO CONVERSION AFTER DOWNLOAD')
+        return None
+
+
+def finish_ffmpeg_pipe(ff_proc: subprocess.Popen, time_start: float) -> float:
+    """ Waits for a piped FFMPEG conversion to complete, returns time spent converting after the download finished """
+    with Loader(PrintChannel.PROGRESS_INFO, "Finishing conversion..."):
+        with Perf.timer('convert'):
+            returncode = ff_proc.wait()
+    
+    time_elapsed = time.time() - time_start
+    
+    if returncode != 0:
+        raise RuntimeError(f'FFMPEG exited with code {returncode} while converting piped stream')
+    
+    return time_elapsed
@@ -0,0 +1,94 @@
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path, PurePath
+from threading import Lock
+from typing import Callable
+
+from zotify.events import EventLog
+from zotify.termoutput import Printer, PrintChannel, Loader
+
+
+class TranscodePool:
+    """
+    Background FFMPEG conversions
+    
+    Each worker thread drives its own FFMPEG process, so conversions run on as many cores as there are workers
+    while the main thread moves on to downloading the next track.
+    """
+    EXECUTOR: ThreadPoolExecutor | None = None
+    PENDING: set[Future] = set()
+    IN_FLIGHT: set[tuple[str, PurePath]] = set()
+    FAILED: set[str] = set()
+    LOCK = Lock()
+    
+    @classmethod
+    def workers(cls) -> int:
+        from zotify.config import Zotify
+        workers = Zotify.CONFIG.get_transcode_workers()
+        return workers if workers > 0 else os.cpu_count() or 1
+    
+    @classmethod
+    def enabled(cls) -> bool:
+        return cls.workers() > 1
+    
+    @classmethod
+    def submit(cls, convert: Callable[[PurePath], float | None], track_path: PurePath,
+               on_complete: Callable[[float | None], None], track_id: str, filedir: PurePath) -> None:
+        """ Queues `convert(track_path)`, passing its result to `on_complete` once the conversion finishes """
+        with cls.LOCK:
+            if cls.EXECUTOR is None:
+                cls.EXECUTOR = ThreadPoolExecutor(max_workers=cls.workers(), thread_name_prefix="zotify-transcode")
+            # not archived until on_complete runs, duplicates later in the run must still see it
+            cls.IN_FLIGHT.add((track_id, filedir))
+            cls.FAILED.discard(track_id)
+            future = cls.EXECUTOR.submit(convert, track_path)
+            cls.PENDING.add(future)
+        future.add_done_callback(lambda f: cls._complete(f, track_path, track_id, filedir, on_complete))
+    
+    @classmethod
+    def in_flight(cls, track_id: str, filedir: PurePath | None = None) -> bool:
+        """ Returns True if `track_id` is queued or converting and not yet archived, only counting `filedir` if given """
+        with cls.LOCK:
+            return any(id == track_id and (filedir is None or dir == filedir) for id, dir in cls.IN_FLIGHT)
+    
+    @classmethod
+    def failed(cls, track_id: str) -> bool:
+        """ Returns True if the last background conversion of `track_id` failed """
+        with cls.LOCK:
+            return track_id in cls.FAILED
+    
+    @classmethod
+    def _complete(cls, future: Future, track_path: PurePath, track_id: str, filedir: PurePath, on_complete: Callable[[float | None], None]) -> None:
+        try:
+            on_complete(future.result())
+        except Exception as e:
+            Printer.hashtaged(PrintChannel.ERROR, 'SKIPPING SONG - BACKGROUND CONVERSION ERROR\n' +\
+                                                 f'Track_Path: {track_path}')
+            Printer.traceback(e)
+            EventLog.emit('error', kind='track', path=track_path, stage='convert', error=type(e).__name__)
+            with cls.LOCK:
+                cls.FAILED.add(track_id)
+            if Path(track_path).exists():
+                Path(track_path).unlink()
+        finally:
+            with cls.LOCK:
+                cls.PENDING.discard(future)
+                cls.IN_FLIGHT.discard((track_id, filedir))
+    
+    @classmethod
+    def queue_depth(cls) -> int:
+        with cls.LOCK:
+            return len(cls.PENDING)
+    
+    @classmethod
+    def join(cls) -> None:
+        """ Blocks until every queued conversion has been tagged and archived """
+        if cls.EXECUTOR is None:
+            return
+        
+        if cls.queue_depth():
+            with Loader(PrintChannel.PROGRESS_INFO, f"Waiting for {cls.queue_depth()} conversion(s) to finish..."):
+                cls.EXECUTOR.shutdown(wait=True)
+        else:
+            cls.EXECUTOR.shutdown(wait=True)
+        cls.EXECUTOR = None
@@ -1,18 +1,25 @@
 import datetime
+import json
 import os
 import re
 import subprocess
-import requests
 import music_tag
+import mutagen
+import mutagen.aac
+import mutagen.flac
+import mutagen.mp3
+import mutagen.mp4
 from music_tag.file import TAG_MAP_ENTRY
 from music_tag.mp4 import freeform_set
 from mutagen.id3 import TXXX
-from time import sleep
+from threading import Lock
 from pathlib import Path, PurePath
 
+from zotify.cache import ArtworkCache
 from zotify.config import Zotify
 from zotify.const import ALBUMARTIST, ARTIST, TRACKTITLE, ALBUM, YEAR, DISCNUMBER, TRACKNUMBER, ARTWORK, \
     TOTALTRACKS, TOTALDISCS, EXT_MAP, LYRICS, COMPILATION, GENRE, EXT_MAP, MP3_CUSTOM_TAG_PREFIX, M4A_CUSTOM_TAG_PREFIX
+from zotify.perf import Perf
 from zotify.termoutput import PrintChannel, Printer
 
 
@@ -165,8 +172,10 @@ def conv_genre_format(genres: list[str]) -> list[str] | str:
         return Zotify.CONFIG.get_genre_delimiter().join(genres)
 
 
-def set_audio_tags(track_path: PurePath, track_metadata: dict, total_discs: str | None, genres: list[str], lyrics: list[str] | None) -> None:
-    """ sets music_tag metadata """
+@Perf.timer('tags')
+def set_audio_tags(track_path: PurePath, track_metadata: dict, total_discs: str | None, genres: list[str], lyrics: list[str] | None,
+                   artwork: bytes | None = None) -> None:
+    """ sets music_tag metadata, including album artwork, in a single load and save of the file """
     
     (scraped_track_id, track_name, artists, artist_ids, release_date, release_year, track_number, total_tracks,
      album, album_artists, disc_number, compilation, duration_ms, image_url, is_playable) = track_metadata.values()
@@ -204,6 +213,9 @@ def set_audio_tags(track_path: PurePath, track_metadata: dict, total_discs: str
     if lyrics and Zotify.CONFIG.get_save_lyrics_tags():
         tags[LYRICS] = "".join(lyrics)
     
+    if artwork:
+        tags[ARTWORK] = artwork
+    
     if ext == "mp3" and not Zotify.CONFIG.get_disc_track_totals():
         # music_tag python library writes DISCNUMBER and TRACKNUMBER as X/Y instead of X for mp3
         # this method bypasses all internal formatting, probably not resilient against arbitrary inputs
@@ -310,14 +322,17 @@ def compare_audio_tags(track_path: str | Path, reliable_tags: tuple, unreliable_
     return mismatches
 
 
-def set_music_thumbnail(track_path: PurePath, image_url: str, mode: str) -> None:
-    """ Fetch an album cover image, set album cover tag, and save to file if desired """
+def get_music_thumbnail(image_url: str, embedded: bool = False) -> bytes:
+    """ Fetch an album cover image, downscaled per config if it is to be embedded in a track """
     
     # jpeg format expected from request
-    img = requests.get(image_url).content
-    tags = music_tag.load_file(track_path)
-    tags[ARTWORK] = img
-    tags.save()
+    if embedded:
+        return ArtworkCache.get_variant(image_url, Zotify.CONFIG.get_album_art_max_size(), Zotify.CONFIG.get_album_art_quality())
+    return ArtworkCache.get(image_url)
+
+
+def save_music_thumbnail(track_path: PurePath, img: bytes, mode: str) -> None:
+    """ Save an album cover image to file if desired """
     
     if not Zotify.CONFIG.get_album_art_jpg_file():
         return
@@ -330,10 +345,69 @@ def set_music_thumbnail(track_path: PurePath, image_url: str, mode: str) -> None
             jpg_file.write(img)
 
 
+def is_ogg_file(file_path: str | PurePath) -> bool:
+    """ Returns True if the file starts with an Ogg page capture pattern """
+    with open(file_path, 'rb') as file:
+        return file.read(4) == b'OggS'
+
+
+SNIFFED_CODECS = {
+    'OggVorbis': 'vorbis',
+    'OggOpus': 'opus',
+    'OggFLAC': 'flac',
+    'OggSpeex': 'speex',
+    'OggTheora': 'theora',
+    'FLAC': 'flac',
+    'MP3': 'mp3',
+    'AAC': 'aac',
+}
+
+
+def sniff_audio_file(file_path: str | PurePath) -> tuple[str | None, float | None]:
+    """ Returns the (codec, duration in seconds) of an audio file by reading its headers in-process,
+    or (None, None) if the container is not recognized """
+    
+    with open(file_path, 'rb') as file:
+        header = file.read(12)
+    
+    # pick the parser from magic bytes, since downloads are sniffed before they get a meaningful extension
+    if header.startswith(b'OggS'):
+        parser = mutagen.File
+    elif header.startswith(b'fLaC'):
+        parser = mutagen.flac.FLAC
+    elif header[4:8] == b'ftyp':
+        parser = mutagen.mp4.MP4
+    elif header.startswith(b'ID3'):
+        parser = mutagen.mp3.MP3
+    elif len(header) >= 2 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0:
+        # MPEG audio frames and ADTS share a sync word, ADTS marks itself with a layer of 0
+        parser = mutagen.aac.AAC if header[1] & 0x06 == 0 else mutagen.mp3.MP3
+    else:
+        return None, None
+    
+    try:
+        audio = parser(file_path)
+    except mutagen.MutagenError:
+        return None, None
+    if audio is None:
+        return None, None
+    
+    if isinstance(audio, mutagen.mp4.MP4):
+        codec = audio.info.codec
+        codec = 'aac' if codec.startswith('mp4a') else codec
+    else:
+        codec = SNIFFED_CODECS.get(type(audio).__name__)
+    return codec, getattr(audio.info, 'length', None)
+
+
 # Time Utils
 def get_downloaded_track_duration(filename: str) -> float:
     """ Returns the downloaded file's duration in seconds """
     
+    _, duration = sniff_audio_file(filename)
+    if duration is not None:
+        return duration
+    
     command = ['ffprobe', '-show_entries', 'format=duration', '-i', f'{filename}']
     output = subprocess.run(command, capture_output=True)
     
@@ -369,17 +443,25 @@ def strptime_utc(dtstr) -> datetime.datetime:
     return datetime.datetime.strptime(dtstr[:-1], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=datetime.timezone.utc)
 
 
+WAIT_LOCK = Lock() # concurrent downloads queue up for their wait, keeping BULK_WAIT_TIME a global rate
+
+
 def wait_between_downloads() -> None:
     waittime = Zotify.CONFIG.get_bulk_wait_time()
     if not waittime or waittime <= 0:
         return
     
-    if waittime > 5:
-        Printer.hashtaged(PrintChannel.DOWNLOADS, f'PAUSED: WAITING FOR {waittime} SECONDS BETWEEN DOWNLOADS')
-    sleep(waittime)
+    with WAIT_LOCK:
+        if waittime > 5:
+            Printer.hashtaged(PrintChannel.DOWNLOADS, f'PAUSED: WAITING FOR {waittime} SECONDS BETWEEN DOWNLOADS')
+        Perf.sleep(waittime)
 
 
 # Song Archive Utils
+ARCHIVE_LOCK = Lock() # archives may be appended to from background conversion workers
+
+
+@Perf.timer('archive')
 def get_archived_entries() -> list[str]:
     """ Returns list of all time downloaded song entries """
     
@@ -403,6 +485,7 @@ def get_archived_song_ids() -> list[str]:
     return track_ids
 
 
+@Perf.timer('archive')
 def add_to_song_archive(track_id: str, filename: str, author_name: str, track_name: str) -> None:
     """ Adds song id to all time installed songs archive """
     
@@ -410,14 +493,42 @@ def add_to_song_archive(track_id: str, filename: str, author_name: str, track_na
         return
     
     archive_path = Zotify.CONFIG.get_song_archive_location()
-    if Path(archive_path).exists():
-        with open(archive_path, 'a', encoding='utf-8') as file:
-            file.write(f'{track_id}\t{datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}\t{author_name}\t{track_name}\t{filename}\n')
-    else:
-        with open(archive_path, 'w', encoding='utf-8') as file:
-            file.write(f'{track_id}\t{datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}\t{author_name}\t{track_name}\t{filename}\n')
+    with ARCHIVE_LOCK:
+        if Path(archive_path).exists():
+            with open(archive_path, 'a', encoding='utf-8') as file:
+                file.write(f'{track_id}\t{datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}\t{author_name}\t{track_name}\t{filename}\n')
+        else:
+            with open(archive_path, 'w', encoding='utf-8') as file:
+                file.write(f'{track_id}\t{datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}\t{author_name}\t{track_name}\t{filename}\n')
 
 
+@Perf.timer('archive')
+def get_archived_episode_ids() -> set[str]:
+    """ Returns set of all-time downloaded episode_ids """
+    
+    archive_path = Zotify.CONFIG.get_podcast_archive_location()
+    
+    episode_ids = set()
+    if Path(archive_path).exists() and not Zotify.CONFIG.get_disable_song_archive():
+        with open(archive_path, 'r', encoding='utf-8') as f:
+            episode_ids.update(line.strip().split('\t')[0] for line in f)
+    
+    return episode_ids
+
+
+@Perf.timer('archive')
+def add_to_podcast_archive(episode_id: str, filename: str, podcast_name: str, episode_name: str) -> None:
+    """ Adds episode id to all time installed episodes archive """
+    
+    if Zotify.CONFIG.get_disable_song_archive():
+        return
+    
+    archive_path = Zotify.CONFIG.get_podcast_archive_location()
+    with ARCHIVE_LOCK, open(archive_path, 'a', encoding='utf-8') as file:
+        file.write(f'{episode_id}\t{datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}\t{podcast_name}\t{episode_name}\t{filename}\n')
+
+
+@Perf.timer('archive')
 def get_directory_song_ids(download_path: str) -> list[str]:
     """ Gets song ids of songs in directory """
     
@@ -432,6 +543,7 @@ def get_directory_song_ids(download_path: str) -> list[str]:
     return track_ids
 
 
+@Perf.timer('archive')
 def add_to_directory_song_archive(track_path: PurePath, track_id: str, author_name: str, track_name: str) -> None:
     """ Appends song_id to .song_ids file in directory """
     
@@ -441,7 +553,7 @@ def add_to_directory_song_archive(track_path: PurePath, track_id: str, author_na
     hidden_file_path = track_path.parent / '.song_ids'
     # not checking if file exists because we need an exception
     # to be raised if something is wrong
-    with open(hidden_file_path, 'a', encoding='utf-8') as file:
+    with ARCHIVE_LOCK, open(hidden_file_path, 'a', encoding='utf-8') as file:
         file.write(f'{track_id}\t{datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}\t{author_name}\t{track_name}\t{track_path.name}\n')
 
 
@@ -456,9 +568,9 @@ def add_to_m3u8(duration_ms: int, track_name: str, track_path: PurePath, m3u8_pa
         m3u8_path = m3u_dir / (Zotify.DATETIME_LAUNCH + "_zotify.m3u8")
     elif m3u8_path.name == "Liked Songs.m3u8": # may get confused if playlist is named "Liked Songs"
         m3u8_path = track_path.parent / (Zotify.DATETIME_LAUNCH + "_zotify.m3u8")
-        if not Path(track_path.parent / "Liked Songs.m3u8").exists() or "justCreatedLikedSongsM3U8" in globals():
+        if not Path(track_path.parent / "Liked Songs.m3u8").exists() or Zotify.LIKED_M3U8_CREATED:
             m3u8_path = track_path.parent / "Liked Songs.m3u8"
-            global justCreatedLikedSongsM3U8; justCreatedLikedSongsM3U8 = True # hacky, terrible, truly awful: too bad!
+            Zotify.LIKED_M3U8_CREATED = True
     
     if not Path(m3u8_path).exists():
         Path(m3u8_path.parent).mkdir(parents=True, exist_ok=True)
@@ -476,6 +588,77 @@ def add_to_m3u8(duration_ms: int, track_name: str, track_path: PurePath, m3u8_pa
     return track_label_m3u
 
 
+def remove_from_m3u8(m3u8_path: PurePath, track_paths: set[str]) -> int:
+    """ Removes the entries pointing at any of `track_paths` from a .m3u8 playlist, returning how many were removed """
+    
+    if not Path(m3u8_path).exists():
+        return 0
+    
+    with open(m3u8_path, 'r', encoding='utf-8') as file:
+        lines = file.readlines()
+    
+    # entries may be written relative to the playlist file
+    targets = {os.path.normpath(path) for path in track_paths}
+    kept = []; removed = 0; i = 0
+    while i < len(lines):
+        if lines[i].startswith("#EXTINF:") and i + 1 < len(lines):
+            entry_path = os.path.join(PurePath(m3u8_path).parent, lines[i + 1].rstrip("\n"))
+            if os.path.normpath(entry_path) in targets:
+                # the label, the entry's path and the blank line after it
+                removed += 1; i += 3
+                continue
+        kept.append(lines[i]); i += 1
+    
+    if removed:
+        temp_path = Path(m3u8_path).with_suffix('.part')
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            file.writelines(kept)
+        temp_path.replace(m3u8_path)
+    return removed
+
+
+def get_playlist_sync_state() -> dict[str, dict]:
+    """ Returns the snapshot_id and tracks of every playlist seen by previous syncs """
+    
+    state_path = Zotify.CONFIG.get_playlist_sync_location()
+    if not Path(state_path).exists():
+        return {}
+    with open(state_path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def save_playlist_sync_state(state: dict[str, dict]) -> None:
+    state_path = Path(Zotify.CONFIG.get_playlist_sync_location())
+    temp_path = state_path.with_suffix('.part')
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        json.dump(state, file, indent=4)
+    temp_path.replace(state_path)
+
+
+def get_liked_songs_watermark() -> datetime.datetime | None:
+    """ Returns when the newest Liked Song seen by the last complete `--liked` run was added, for the current account """
+    
+    state_path = Zotify.CONFIG.get_liked_songs_state_location()
+    if not Path(state_path).exists():
+        return None
+    with open(state_path, 'r', encoding='utf-8') as file:
+        added_at = json.load(file).get(Zotify.SESSION.username(), {}).get('added_at')
+    return strptime_utc(added_at) if added_at else None
+
+
+def set_liked_songs_watermark(added_at: str) -> None:
+    state_path = Path(Zotify.CONFIG.get_liked_songs_state_location())
+    state = {}
+    if state_path.exists():
+        with open(state_path, 'r', encoding='utf-8') as file:
+            state = json.load(file)
+    state[Zotify.SESSION.username()] = {'added_at': added_at}
+    temp_path = state_path.with_suffix('.part')
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        json.dump(state, file, indent=4)
+    temp_path.replace(state_path)
+
+
 def fetch_m3u8_songs(m3u8_path: PurePath) -> list[str] | None:
     """ Fetches the songs and associated file paths in an .m3u8 playlist"""
     